@@ -0,0 +1,39 @@
+"""
+Adversarial inputs for the regular expressions of sixer, shared by
+bench_regex.py and regex_stress.py.
+
+An input is made of a head (ex: an open parenthesis), a unit repeated n
+times (ex: '.attr' for a long dotted name) and a tail which makes the match
+fail.
+"""
+
+
+# name => (head, unit repeated n times, tail)
+SHAPES = {
+    'dotted': ('obj', '.attr', '.'),
+    'indexed': ('obj', '[key]', '!'),
+    'called': ('func', '(arg)', '!'),
+    'chained': ('obj', '.attr[0].meth(x)', '!'),
+    'identifier': ('', 'name_0', '!'),
+    'open_brackets': ('', 'a[', ''),
+    'open_parens': ('', 'f(', ''),
+    'nested_calls': ('', 'f(', ')' * 3),
+    'close_parens': ('', 'x)', ''),
+    'unclosed_bracket': ('a[', 'x ', ''),
+    'unclosed_paren': ('(', 'x ', ''),
+    'unclosed_call': ('f(', 'x ', ''),
+    'unclosed_nested': ('(a(b) ', 'x ', ''),
+    'unclosed_string': ('"', 'x\\t', ''),
+    'comma_list': ('', 'a.b, ', '!'),
+    'qualname_list': ('', 'mod.Error, ', '!'),
+    'open_list': ('[', 'a, ', ''),
+    'list': ('[', 'a.b[0], ', '!'),
+    'tuple': ('(', '"str", ', '!'),
+    'escapes': ('"', '\\', ''),
+    'spaces': ('', ' ', '!'),
+}
+
+
+def make_input(shape, size):
+    head, unit, tail = shape
+    return head + unit * size + tail
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Benchmark the throughput of sixer on a synthetic corpus of Python 2 modules.
+
+The corpus is generated by corpus.py with a fixed seed. The suite times:
+
+* operation:NAME: Operation.patch() of each operation on every module;
+* add_import_names: Patcher.add_import_names() adding 'import six';
+* patcher.patch: Patcher.patch() of every module with all operations (dry
+  run: files are not modified).
+
+Results are displayed in files/s and MB/s. Use --output to write them into
+a JSON file, and --compare to compare them to a saved baseline:
+
+    bench_patch.py --output baseline.json
+    (modify sixer)
+    bench_patch.py --compare baseline.json
+"""
+import contextlib
+import io
+import json
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+import corpus
+import sixer
+
+
+def patcher_options():
+    options = types.SimpleNamespace()
+    options.max_range = sixer.MAX_RANGE
+    options.to_stdout = False
+    options.quiet = True
+    options.app = None
+    options.third_party = None
+    options.write = False
+    # Don't keep warnings in memory: Patcher.warnings would grow at each run
+    options.no_warning_replay = True
+    return options
+
+
+def bench_operation(name, modules):
+    patcher = sixer.Patcher((name,), patcher_options())
+    operation = patcher.operations[0]
+    for filename, content in modules:
+        operation.patch(sixer.FileJob(filename, content), content)
+
+
+def bench_add_import_names(modules):
+    patcher = sixer.Patcher((), patcher_options())
+    for filename, content in modules:
+        patcher.add_import_names(content, 'import six', ['six'])
+
+
+def bench_patcher_patch(filenames):
+    patcher = sixer.Patcher(('all',), patcher_options())
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        for filename in filenames:
+            patcher.patch(filename)
+
+
+def run_benchmark(func, args, loops, min_time=0.2):
+    # Return the best time of loops runs. Fast benchmarks are repeated
+    # in each run to last at least min_time seconds.
+    start = time.perf_counter()
+    func(*args)
+    dt = time.perf_counter() - start
+    inner = max(int(min_time / dt), 1) if dt else 1000
+
+    best = None
+    for _ in range(loops):
+        start = time.perf_counter()
+        for _ in range(inner):
+            func(*args)
+        dt = (time.perf_counter() - start) / inner
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def run_suite(modules, filenames, loops, names):
+    nfile = len(modules)
+    size = sum(len(content.encode('utf-8')) for name, content in modules)
+
+    benchmarks = [('operation:%s' % name, bench_operation, (name, modules))
+                  for name in names]
+    benchmarks.append(('add_import_names', bench_add_import_names,
+                       (modules,)))
+    benchmarks.append(('patcher.patch', bench_patcher_patch, (filenames,)))
+
+    results = {}
+    for name, func, args in benchmarks:
+        dt = run_benchmark(func, args, loops)
+        results[name] = {
+            'seconds': dt,
+            'files_per_sec': nfile / dt,
+            'mb_per_sec': size / dt / 1e6,
+        }
+        print("%-22s %9.3f sec %10.0f files/s %8.2f MB/s"
+              % (name, dt, nfile / dt, size / dt / 1e6))
+    return results, size
+
+
+def compare(results, metadata, baseline, threshold):
+    """Compare results to baseline: return the names of the benchmarks
+    slower than threshold (ex: 0.10 for 10%)."""
+    for key in ('seed', 'files', 'bytes'):
+        if baseline['metadata'].get(key) != metadata[key]:
+            print("WARNING: the baseline was run with a different corpus "
+                  "(%s: %s != %s)"
+                  % (key, baseline['metadata'].get(key), metadata[key]))
+
+    print()
+    print("%-22s %12s %12s %9s" % ("Benchmark", "Baseline", "Current",
+                                   "Change"))
+    slower = []
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        change = result['seconds'] / base['seconds'] - 1.0
+        flag = ''
+        if change > threshold:
+            flag = '  SLOWER'
+            slower.append(name)
+        elif change < -threshold:
+            flag = '  faster'
+        print("%-22s %8.0f f/s %8.0f f/s %+8.1f%%%s"
+              % (name, base['files_per_sec'], result['files_per_sec'],
+                 change * 100, flag))
+    return slower
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--files', type="int", default=200,
+                      help="Number of modules of the corpus "
+                           "(default: %default)")
+    parser.add_option('--seed', type="int", default=0,
+                      help="Seed of the corpus generator (default: %default)")
+    parser.add_option('--loops', type="int", default=3,
+                      help="Number of runs of each benchmark, the best time "
+                           "is kept (default: %default)")
+    parser.add_option('--operations',
+                      help="Comma separated list of operations to benchmark "
+                           "(default: all)")
+    parser.add_option('-o', '--output', metavar="FILENAME",
+                      help="Write results into a JSON file")
+    parser.add_option('--compare', metavar="FILENAME",
+                      help="Compare results to a baseline JSON file")
+    parser.add_option('--threshold', type="float", default=0.10,
+                      help="With --compare, exit with code 1 if a benchmark "
+                           "is slower by more than THRESHOLD "
+                           "(default: %default)")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("no argument expected")
+
+    if options.operations:
+        names = options.operations.split(',')
+        for name in names:
+            if name not in sixer.OPERATION_NAMES or name == sixer.All.NAME:
+                parser.error("invalid operation: %s" % name)
+    else:
+        names = [operation.NAME for operation in sixer.OPERATIONS
+                 if operation is not sixer.All]
+
+    baseline = None
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as fp:
+            baseline = json.load(fp)
+
+    modules = corpus.generate_corpus(options.files, options.seed)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filenames = corpus.write_corpus(modules, tmpdir)
+        results, size = run_suite(modules, filenames, options.loops, names)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    metadata = {
+        'seed': options.seed,
+        'files': options.files,
+        'bytes': size,
+        'loops': options.loops,
+        'sixer_version': sixer.VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as fp:
+            json.dump({'metadata': metadata, 'results': results}, fp,
+                      indent=2, sort_keys=True)
+            fp.write("\n")
+        print()
+        print("Results written into %s" % options.output)
+
+    if baseline is not None:
+        slower = compare(results, metadata, baseline, options.threshold)
+        if slower:
+            print()
+            print("Slower than the baseline: %s" % ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
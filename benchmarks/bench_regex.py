@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark the expression regular expressions of sixer on pathological
+inputs of adversarial.py: long dotted, indexed or called expressions, long
+lists which fail to match, unbalanced brackets, etc.
+
+Compare the atomic build (possessive quantifiers and atomic groups, Python
+3.11 and newer) to the backtracking build, and display how the time grows
+when the input size doubles: a ratio close to 2 means linear time.
+
+A match is attempted at a single position ("match"), and searched in the
+whole input ("search"): search retries at each start position, so its time
+grows quadratically with the length of a single long expression.
+"""
+import optparse
+import os
+import re
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+import adversarial
+import sixer
+
+
+# inputs only matched by EXPR_STRING_REGEX
+EXPR_STRING_INPUTS = ('list', 'tuple')
+
+# name => (regex template, prefix of the input)
+REGEXES = {
+    'iteritems': (r"(%(expr)s)\.iteritems\(\)", ''),
+    'raise3': (r"raise (%(expr)s), *(%(expr)s), *(%(expr)s)", 'raise '),
+    'print_into': (r"\bprint ?( *)>>(%(expr)s), *(%(expr_string)s)(?! *,)$",
+                   'print >>f, '),
+    'string_args': (r"\bstring\.(split)\((%(expr_string)s), *([^)]+)\)",
+                    'string.split('),
+}
+
+
+def compile_regexes(atomic):
+    expr, string, expr_string = sixer.expr_regexes(atomic)
+    names = {'expr': expr, 'string': string, 'expr_string': expr_string}
+    return {name: re.compile(template % names, re.MULTILINE)
+            for name, (template, prefix) in REGEXES.items()}
+
+
+def bench(func, text, loops):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(text)
+        dt = (time.perf_counter() - start) / loops
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--size', type="int", default=500,
+                      help="Smallest input size (default: %default)")
+    parser.add_option('--search', action="store_true",
+                      help="Also benchmark search (quadratic time)")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("no argument expected")
+
+    sizes = (options.size, options.size * 2, options.size * 4)
+    builds = [('atomic', True), ('backtrack', False)]
+    if not sixer.ATOMIC_REGEX:
+        print("Python %s.%s doesn't support possessive quantifiers: "
+              "only the backtracking build is benchmarked"
+              % sys.version_info[:2])
+        builds = builds[1:]
+    modes = ['match']
+    if options.search:
+        modes.append('search')
+
+    compiled = {build: compile_regexes(atomic) for build, atomic in builds}
+    print("%-12s %-16s %-11s %-6s %s  growth"
+          % ("Regex", "Input", "Build", "Mode",
+             " ".join("%9s" % ("n=%s" % size) for size in sizes)))
+    for regex_name, (template, prefix) in REGEXES.items():
+        for input_name, shape in adversarial.SHAPES.items():
+            if (input_name in EXPR_STRING_INPUTS
+               and 'expr_string' not in template):
+                continue
+            texts = [prefix + adversarial.make_input(shape, size)
+                     for size in sizes]
+            for build, atomic in builds:
+                regex = compiled[build][regex_name]
+                for mode in modes:
+                    func = getattr(regex, mode)
+                    loops = 20 if mode == 'match' else 1
+                    timings = [bench(func, text, loops) for text in texts]
+                    growth = timings[-1] / timings[-2]
+                    print("%-12s %-16s %-11s %-6s %s  %.1fx"
+                          % (regex_name, input_name, build, mode,
+                             " ".join("%7.3fms" % (dt * 1e3)
+                                      for dt in timings),
+                             growth))
+
+
+if __name__ == "__main__":
+    main()
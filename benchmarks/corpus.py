@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic corpus of OpenStack-style Python 2 modules.
+
+The generator is seeded: the same seed and number of files always produce
+the same corpus. Modules vary in size, in the layout of their import groups
+(license header, docstring, __future__ imports, stdlib, third party and
+application groups) and in the density of Python 2 constructs patched by
+sixer: dict.iteritems(), xrange(), print, 'except X, e', urllib, etc.
+
+Usage: corpus.py [options] OUTPUT_DIR
+"""
+import optparse
+import os
+import random
+
+
+LICENSE = """\
+# Copyright %(year)s %(company)s
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+
+COMPANIES = ('OpenStack Foundation', 'Red Hat, Inc.',
+             'Hewlett-Packard Development Company, L.P.', 'Rackspace Hosting')
+PROJECTS = ('nova', 'cinder', 'glance', 'neutron', 'swift', 'heat')
+STDLIB_IMPORTS = ('import collections', 'import copy', 'import datetime',
+                  'import functools', 'import itertools', 'import json',
+                  'import logging', 'import os', 'import re', 'import socket',
+                  'import sys', 'import time', 'import uuid')
+THIRD_PARTY_IMPORTS = ('import eventlet', 'import mock', 'import netaddr',
+                       'from oslo_config import cfg',
+                       'from oslo_log import log as logging',
+                       'from oslo_utils import excutils',
+                       'from oslo_utils import timeutils', 'import routes',
+                       'import sqlalchemy as sa', 'import webob.exc')
+APP_IMPORTS = ('from %(project)s import context',
+               'from %(project)s import exception',
+               'from %(project)s.i18n import _',
+               'from %(project)s import objects',
+               'from %(project)s import utils')
+NAMES = ('instance', 'volume', 'image', 'network', 'port', 'server', 'host',
+         'flavor', 'quota', 'snapshot', 'stack', 'resource')
+EXCEPTIONS = ('ValueError', 'KeyError', 'TypeError', 'IOError',
+              'exception.NotFound', 'exception.Invalid')
+
+# Python 2 construct => (template, imports required by the template)
+CONSTRUCTS = {
+    'iteritems': (['for key, value in %(obj)s.iteritems():',
+                   '    %(var)s[key] = value'], ()),
+    'itervalues': (['for value in self.%(name)ss.itervalues():',
+                    '    value.refresh()'], ()),
+    'iterkeys': (['keys = sorted(%(obj)s.iterkeys())'], ()),
+    'has_key': (['if %(obj)s.has_key(%(name)s_id):',
+                 '    return %(obj)s[%(name)s_id]'], ()),
+    'next': (['first = iter(self.%(name)ss).next()'], ()),
+    'xrange': (['for index in xrange(%(count)s):',
+                '    self._retry(index)'], ()),
+    'print': (['print "Updating %(name)s"', 'print %(var)s'], ()),
+    'print_into': (['print >>sys.stderr, "failed to update %(name)s"'],
+                   ('import sys',)),
+    'except': (['try:',
+                '    self._update(%(var)s)',
+                'except %(exc)s, exc:',
+                '    LOG.error(_("Failed: %%s"), exc)'], ()),
+    'raise': (['raise %(exc)s, "invalid %(name)s"'], ()),
+    'urllib': (['url = urllib.quote(%(var)s)',
+                'response = urllib2.urlopen(url)'],
+               ('import urllib', 'import urllib2')),
+    'unicode': (['if isinstance(%(var)s, unicode):',
+                 '    %(var)s = %(var)s.encode("utf-8")'], ()),
+    'basestring': (['if not isinstance(%(var)s, basestring):',
+                    '    raise exception.Invalid()'], ()),
+    'long': (['%(var)s_size = %(count)sL'], ()),
+    'stringio': (['buf = StringIO.StringIO()'], ('import StringIO',)),
+    'dict0': (['%(var)s = %(obj)s.keys()[0]'], ()),
+    'string': (['%(var)s = string.upper(%(var)s)'], ('import string',)),
+    'six_moves': (['%(var)s = reduce(lambda x, y: x + y, %(var)s)'], ()),
+}
+
+CONSTRUCT_NAMES = sorted(CONSTRUCTS)
+
+# Plain Python code, not patched by sixer
+FILLERS = (
+    ['%(var)s = self._get_%(name)s(context, %(name)s_id)'],
+    ['LOG.debug("Updating %(name)s %%s", %(var)s)'],
+    ['if %(var)s is None:', '    return None'],
+    ['# Make sure the %(name)s is still available'],
+    ['%(var)s = dict(id=%(name)s_id, status="active")'],
+    ['values = [item.to_dict() for item in %(var)s]'],
+    ['self.%(name)s_api.update(context, %(var)s, values)'],
+)
+
+# Import group layouts
+LAYOUTS = ('openstack', 'future', 'single', 'docstring', 'no_imports')
+
+
+def _fill(rng, template, project):
+    name = rng.choice(NAMES)
+    values = {
+        'name': name,
+        'var': name,
+        'obj': rng.choice(('self.%ss' % name, name + 's', 'kwargs',
+                           'self._cache[%s_id]' % name)),
+        'count': rng.randint(2, 100),
+        'exc': rng.choice(EXCEPTIONS),
+        'project': project,
+    }
+    return [line % values for line in template]
+
+
+def _import_groups(rng, layout, project, imports):
+    stdlib = set(rng.sample(STDLIB_IMPORTS, rng.randint(1, 5)))
+    stdlib |= {line for line in imports if line in STDLIB_IMPORTS
+               or line in ('import urllib', 'import urllib2',
+                           'import StringIO', 'import string')}
+    third_party = set(rng.sample(THIRD_PARTY_IMPORTS, rng.randint(0, 4)))
+    app = {line % {'project': project}
+           for line in rng.sample(APP_IMPORTS, rng.randint(1, 4))}
+
+    def sort(lines):
+        return sorted(lines, key=lambda line: (line.split()[1], line))
+
+    if layout == 'single':
+        return [sort(stdlib | third_party | app)]
+    groups = [sort(stdlib), sort(third_party), sort(app)]
+    groups = [group for group in groups if group]
+    if layout == 'future':
+        groups.insert(0, ['from __future__ import absolute_import'])
+    return groups
+
+
+def generate_module(rng, project=None):
+    """Generate the source code of a Python 2 module using rng."""
+    project = project or rng.choice(PROJECTS)
+    layout = rng.choice(LAYOUTS)
+    # number of blocks of code and density of Python 2 constructs:
+    # most modules are small, a few are large
+    nblock = min(int(rng.paretovariate(1.2) * 10), 500)
+    density = rng.choice((0.05, 0.2, 0.5))
+
+    body = []
+    imports = set()
+    for index in range(nblock):
+        if index % 8 == 0:
+            body.extend(['', '',
+                         'class %sManager(object):'
+                         % rng.choice(NAMES).capitalize(),
+                         '    """Manage %ss."""' % rng.choice(NAMES)])
+        if index % 8 == 0 or rng.random() < 0.3:
+            body.extend(['', '    def %s_%s(self, context, %s_id):'
+                         % (rng.choice(('get', 'update', 'delete', 'list')),
+                            rng.choice(NAMES), rng.choice(NAMES))])
+        if rng.random() < density:
+            template, required = CONSTRUCTS[rng.choice(CONSTRUCT_NAMES)]
+            imports.update(required)
+        else:
+            template = rng.choice(FILLERS)
+        body.extend('        ' + line
+                    for line in _fill(rng, template, project))
+
+    lines = []
+    if layout != 'no_imports':
+        header = LICENSE % {'year': rng.randint(2010, 2015),
+                            'company': rng.choice(COMPANIES)}
+        lines.extend(header.splitlines())
+        lines.append('')
+    if layout in ('docstring', 'future') or rng.random() < 0.3:
+        lines.extend(['"""%s %s utilities."""'
+                      % (project.capitalize(), rng.choice(NAMES)), ''])
+    if layout != 'no_imports' or imports:
+        for group in _import_groups(rng, layout, project, imports):
+            lines.extend(group)
+            lines.append('')
+        lines.extend(['', 'LOG = logging.getLogger(__name__)'])
+    lines.extend(body)
+    return '\n'.join(lines).lstrip('\n') + '\n'
+
+
+def generate_corpus(nfile, seed=0):
+    """Generate a list of (filename, source code) of nfile modules."""
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(nfile):
+        project = rng.choice(PROJECTS)
+        filename = os.path.join(project, 'module%04d.py' % index)
+        corpus.append((filename, generate_module(rng, project)))
+    return corpus
+
+
+def write_corpus(corpus, path):
+    """Write the corpus into the directory path, return the filenames."""
+    filenames = []
+    for name, content in corpus:
+        filename = os.path.join(path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as fp:
+            fp.write(content)
+        filenames.append(filename)
+    return filenames
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] OUTPUT_DIR")
+    parser.add_option('--files', type="int", default=200,
+                      help="Number of modules (default: %default)")
+    parser.add_option('--seed', type="int", default=0,
+                      help="Seed of the random generator (default: %default)")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("missing output directory")
+
+    corpus = generate_corpus(options.files, options.seed)
+    write_corpus(corpus, args[0])
+    size = sum(len(content) for name, content in corpus)
+    print("Wrote %s modules (%.1f kB) into %s"
+          % (len(corpus), size / 1024, args[0]))
+
+
+if __name__ == "__main__":
+    main()
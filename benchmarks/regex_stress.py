@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Stress the regular expressions of sixer operations with adversarial lines.
+
+Each line is made of a prefix which starts a candidate match (ex: 'raise ')
+and an adversarial input of adversarial.py: a head (ex: an open
+parenthesis), a unit repeated n times (ex: '.attr' for a long dotted name)
+and a tail which makes the match fail. The time of a single match attempt
+at the start of the line is measured for growing n: the script fails if the
+time grows faster than linearly, which is the sign of catastrophic
+backtracking.
+
+Timings are noisy: each time is the median of --repeat measures, and the
+growth is compared to the growth of a linear control regex measured on the
+same lines, so a machine slowing down during a measure doesn't look like
+backtracking.
+
+Searching a match in a line (re.search) retries at each position, so its
+time is the sum of many attempts. A single attempt is measured to only
+detect backtracking.
+
+Units are the shapes of adversarial.py (long dotted names, unbalanced
+brackets, deeply nested calls, etc.) and random units (fuzzing, seeded by
+--seed).
+
+Exit with code 1 if a regular expression is superlinear.
+"""
+import math
+import optparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+import adversarial
+import sixer
+
+
+# name => (compiled regex, prefix of the lines)
+PATTERNS = {
+    'Raise.RAISE3_REGEX': (sixer.Raise.RAISE3_REGEX, 'raise '),
+    'Except.EXCEPT2_REGEX': (sixer.Except.EXCEPT2_REGEX, 'except ('),
+    'Print.REGEX_INTO': (sixer.Print.REGEX_INTO, 'print >>'),
+    'String.REGEX_ARGS': (sixer.String.REGEX_ARGS, 'string.split('),
+    'Next.REGEX': (sixer.Next.REGEX, ''),
+}
+
+# Linear regex: a match attempt reads the whole line and fails
+CONTROL_REGEX = re.compile(r'[^\n]*\n')
+
+# Tokens of random units
+TOKENS = ('a', 'b1', '_', '.', '[', ']', '(', ')', ',', ' ', ', ', '"', "'",
+          '\\', '\\n', '0', '>>', ':', 'next()', '.next', 'raise ')
+
+
+def random_units(seed, count):
+    rng = random.Random(seed)
+    units = []
+    for index in range(count):
+        head = ''.join(rng.choice(TOKENS) for _ in range(rng.randint(0, 3)))
+        unit = ''.join(rng.choice(TOKENS) for _ in range(rng.randint(1, 4)))
+        units.append(('random%s' % index, (head, unit, '')))
+    return units
+
+
+def time_match(regex, line, min_time, repeat):
+    # Median time of a match attempt at the start of line
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            regex.match(line)
+        if time.perf_counter() - start >= min_time:
+            break
+        loops *= 2
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            regex.match(line)
+        timings.append((time.perf_counter() - start) / loops)
+    return statistics.median(timings)
+
+
+def growth_exponent(regex, lines, sizes, min_time, repeat):
+    """Estimate k of 'time ~ n ** k' from the smallest and largest sizes."""
+    timings = [time_match(regex, line, min_time, repeat) for line in lines]
+    return math.log(timings[1] / timings[0]) / math.log(sizes[-1] / sizes[0])
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--size', type="int", default=250,
+                      help="Smallest number of units (default: %default)")
+    parser.add_option('--factor', type="int", default=8,
+                      help="Ratio between the largest and the smallest "
+                           "number of units (default: %default)")
+    parser.add_option('--threshold', type="float", default=1.5,
+                      help="Fail if time grows faster than "
+                           "n ** THRESHOLD (default: %default)")
+    parser.add_option('--random', type="int", default=50,
+                      help="Number of random units (default: %default)")
+    parser.add_option('--seed', type="int", default=0,
+                      help="Seed of random units (default: %default)")
+    parser.add_option('--min-time', type="float", default=0.005,
+                      help="Minimum duration of a measure in seconds "
+                           "(default: %default)")
+    parser.add_option('--repeat', type="int", default=5,
+                      help="Number of measures of each time, the median is "
+                           "kept (default: %default)")
+    parser.add_option('-v', '--verbose', action="store_true",
+                      help="Display the exponent of every unit")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("no argument expected")
+
+    sizes = (options.size, options.size * options.factor)
+    units = (list(adversarial.SHAPES.items())
+             + random_units(options.seed, options.random))
+
+    failures = []
+    for name, (regex, prefix) in PATTERNS.items():
+        worst = None
+        for unit_name, shape in units:
+            unit = '%r + %r * n' % shape[:2]
+            lines = [prefix + adversarial.make_input(shape, size)
+                     for size in sizes]
+            exponent = growth_exponent(regex, lines, sizes,
+                                       options.min_time, options.repeat)
+            control = growth_exponent(CONTROL_REGEX, lines, sizes,
+                                      options.min_time, options.repeat)
+            # The control regex is linear: its exponent above 1 is noise
+            exponent -= max(control - 1.0, 0.0)
+            if options.verbose:
+                print("%-22s %-16s %-28s n**%.2f"
+                      % (name, unit_name, unit, exponent))
+            if worst is None or exponent > worst[0]:
+                worst = (exponent, unit_name, unit)
+            if exponent > options.threshold:
+                failures.append((name, unit_name, unit, exponent))
+        status = 'ok' if worst[0] <= options.threshold else 'SUPERLINEAR'
+        print("%-22s worst: n**%.2f (%s: %r) %s"
+              % (name, worst[0], worst[1], worst[2], status))
+
+    if failures:
+        print()
+        for name, unit_name, unit, exponent in failures:
+            print("FAIL: %s grows as n**%.2f on %s: %s"
+                  % (name, exponent, unit_name, unit))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
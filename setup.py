@@ -6,7 +6,7 @@
 #  - fill the changelog in README.rst
 #  - check that "python3 setup.py sdist" contains all files tracked by
 #    the SCM (Mercurial): update MANIFEST.in if needed
-#  - update version in setup.py
+#  - update version in setup.py and VERSION in sixer.py
 #  - set release date in the changelog in README.rst
 #  - check README.rst: tox
 #  - git commit -a
@@ -21,7 +21,7 @@
 #
 # After the release:
 #
-#  - increment version in setup.py
+#  - increment version in setup.py and VERSION in sixer.py
 #  - git commit -a -m "post-release"
 #  - git push
 
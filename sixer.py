@@ -1,12 +1,55 @@
 #!/usr/bin/env python3
+import array
+import bisect
+import codecs
 import collections
+import concurrent.futures
+import contextlib
+import fnmatch
 import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import multiprocessing.connection
 import optparse
 import os
 import re
+import sqlite3
+import stat
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import tokenize
 
+VERSION = "1.6.2"
+
+# Directory of the result cache (--cache option)
+CACHE_DIR = ".sixer_cache"
+
+# Number of written files flushed together by --fsync=batch
+FSYNC_BATCH = 100
+
+# Files larger than this size (in bytes) are searched for triggers using
+# mmap, without reading them
+MMAP_THRESHOLD = 1024 * 1024
+
+# Maximum number of regular expressions compiled at runtime kept by the
+# RegexCache of a Patcher
+REGEX_CACHE_SIZE = 256
+
+# Maximum length of the name of the current operation of a worker process
+# (--file-timeout option)
+PROGRESS_SIZE = 128
+
+# Maximum size of the first two lines of a file containing a coding cookie
+MAX_COOKIE_LINES = 4096
+
 # Maximum range which creates a list on Python 2. For example, xrange(10) can
 # be replaced with range(10) without "from six.moves import range".
 MAX_RANGE = 1024
@@ -77,6 +120,26 @@ APPLICATION_MODULES = set((
     "swift",
 ))
 
+# Names of directories and files skipped when walking directories
+DEFAULT_EXCLUDES = (
+    ".eggs",
+    ".git",
+    ".tox",
+    ".venv",
+    "__pycache__",
+    "build",
+    "node_modules",
+)
+
+# Names of files patched when walking directories
+DEFAULT_INCLUDES = ("*.py",)
+
+
+def compile_globs(patterns):
+    """Compile a list of glob patterns into a regular expression."""
+    return re.compile('|'.join(fnmatch.translate(pattern)
+                               for pattern in patterns))
+
 # Ugly regular expressions because I'm too lazy to write a real parser,
 # and Match objects are convinient to modify code in-place
 
@@ -98,46 +161,116 @@ def from_import_regex(module, symbol):
 IDENTIFIER_REGEX = r'[a-zA-Z_][a-zA-Z0-9_]*'
 # 'name', 'module.name'
 QUALNAME_REGEX = r'%s(?:\.%s)*' % (IDENTIFIER_REGEX, IDENTIFIER_REGEX)
+
+# Use possessive quantifiers and atomic groups (Python 3.11 and newer) in
+# expressions: they don't backtrack into identifiers, suffixes and strings.
+ATOMIC_REGEX = (sys.version_info >= (3, 11))
+
+
+def _expr_regex_parts(atomic):
+    """Build the regular expressions matching Python expressions and their
+    parts: return a dict name => regular expression.
+
+    If atomic is true, quantifiers and groups which cannot match differently
+    in the contexts where sixer uses these expressions don't backtrack.
+    EXPR_REGEX keeps backtracking on its '.attr' parts, since it is
+    followed by '.method()' in many regular expressions.
+    """
+    if atomic:
+        # possessive quantifier
+        many = '*+'
+        once = '++'
+        group = '(?>%s)'
+    else:
+        many = '*'
+        once = '+'
+        group = '(?:%s)'
+
+    # 'identifier', 'var3', 'NameCamelCase'
+    identifier = r'[a-zA-Z_][a-zA-Z0-9_]%s' % many
+    # '[0]'
+    getitem = r'\[[^]]%s\]' % once
+    # '()' or '(obj, {})', don't support nested calls: 'f(g())'
+    call = r'\([^()]%s\)' % many
+    # '[0]' or '(obj, {})' or '()[key]'
+    suffix = r'(?:%s|%s)' % (getitem, call)
+    # 'var' or 'var[0]' or 'func()' or 'func()[0]'
+    subexpr = r'%s(?:%s)%s' % (identifier, suffix, many)
+    # 'inst' or 'self.attr' or 'self.attr[0]'
+    expr = r'%s(?:\.%s)*' % (subexpr, subexpr)
+
+    # '"hello"', "'hello'"
+    quote1_string = r'"(?:[^"\\]|\\[tn"])%s"' % many
+    quote2_string = r"'(?:[^'\\]|\\[tn'])%s'" % many
+    string = r'(?:%s|%s)' % (quote1_string, quote2_string)
+    item = group % ('%s|%s' % (expr, string))
+    # [a, b, c]
+    list_regex = r'\[ *%s *(?:, *%s *)*\]' % (item, item)
+    # (a,)
+    tuple1 = r'\( *%s *, *\)' % item
+    # (a, b, c)
+    tuplen = r'\( *%s *(?:, *%s *)+\)' % (item, item)
+
+    # expr, 'string', (a, b, c), [a, b, c]
+    expr_string = group % '|'.join((expr, string, list_regex,
+                                    tuple1, tuplen))
+    return {'getitem': getitem, 'call': call, 'suffix': suffix,
+            'subexpr': subexpr, 'expr': expr,
+            'quote1_string': quote1_string, 'quote2_string': quote2_string,
+            'string': string, 'item': item, 'list': list_regex,
+            'tuple1': tuple1, 'tuplen': tuplen, 'expr_string': expr_string}
+
+
+def expr_regexes(atomic=ATOMIC_REGEX):
+    """Build the regular expressions matching Python expressions.
+
+    Return (EXPR_REGEX, STRING_REGEX, EXPR_STRING_REGEX). See
+    _expr_regex_parts() for atomic.
+    """
+    parts = _expr_regex_parts(atomic)
+    return (parts['expr'], parts['string'], parts['expr_string'])
+
+
+_EXPR_PARTS = _expr_regex_parts(ATOMIC_REGEX)
 # '[0]'
-GETITEM_REGEX = r'\[[^]]+\]'
+GETITEM_REGEX = _EXPR_PARTS['getitem']
 # '()' or '(obj, {})', don't support nested calls: 'f(g())'
-CALL_REGEX = r'\([^()]*\)'
+CALL_REGEX = _EXPR_PARTS['call']
 # '[0]' or '(obj, {})' or '()[key]'
-SUFFIX_REGEX = r'(?:%s|%s)' % (GETITEM_REGEX, CALL_REGEX)
+SUFFIX_REGEX = _EXPR_PARTS['suffix']
 # 'var' or 'var[0]' or 'func()' or 'func()[0]'
-SUBEXPR_REGEX = r'%s(?:%s)*' % (IDENTIFIER_REGEX, SUFFIX_REGEX)
+SUBEXPR_REGEX = _EXPR_PARTS['subexpr']
 # 'inst' or 'self.attr' or 'self.attr[0]'
-EXPR_REGEX = r'%s(?:\.%s)*' % (SUBEXPR_REGEX, SUBEXPR_REGEX)
-
+EXPR_REGEX = _EXPR_PARTS['expr']
 # '"hello"', "'hello'"
-_QUOTE1_STRING_REGEX = r'"(?:[^"\\]|\\[tn"])*"'
-_QUOTE2_STRING_REGEX = r"'(?:[^'\\]|\\[tn'])*'"
-STRING_REGEX = r'(?:%s|%s)' % (_QUOTE1_STRING_REGEX, _QUOTE2_STRING_REGEX)
-_EXPR_STRING_REGEX = '(?:%s|%s)' % (EXPR_REGEX, STRING_REGEX)
+_QUOTE1_STRING_REGEX = _EXPR_PARTS['quote1_string']
+_QUOTE2_STRING_REGEX = _EXPR_PARTS['quote2_string']
+STRING_REGEX = _EXPR_PARTS['string']
+_EXPR_STRING_REGEX = _EXPR_PARTS['item']
 # [a, b, c]
-LIST_REGEX = (r'\[ *%s *(?:, *%s *)*\]'
-              % (_EXPR_STRING_REGEX,
-                 _EXPR_STRING_REGEX))
+LIST_REGEX = _EXPR_PARTS['list']
 # (a,)
-_TUPLE1_REGEX = r'\( *%s *, *\)' % _EXPR_STRING_REGEX
-
+_TUPLE1_REGEX = _EXPR_PARTS['tuple1']
 # (a, b, c)
-_TUPLEN_REGEX = (r'\( *%s *(?:, *%s *)+\)'
-                 % (_EXPR_STRING_REGEX, _EXPR_STRING_REGEX))
-
+_TUPLEN_REGEX = _EXPR_PARTS['tuplen']
 # expr, 'string', (a, b, c), [a, b, c]
-EXPR_STRING_REGEX = ('(?:%s)'
-                     % '|'.join((EXPR_REGEX, STRING_REGEX, LIST_REGEX,
-                                 _TUPLE1_REGEX, _TUPLEN_REGEX)))
+EXPR_STRING_REGEX = _EXPR_PARTS['expr_string']
 
 # '(...)'
 SUBPARENT_REGEX= r'\([^()]+\)'
-# '(...)' or '(...(...)...)' (max: 1 level of nested parenthesis)
-PARENT_REGEX = r'\([^()]*(?:%s)?[^()]*\)' % SUBPARENT_REGEX
+# '(...)' or '(...(...)...)' (max: 1 level of nested parenthesis).
+# The text after the nested parenthesis is only matched after it: on a
+# missing ')', a match attempt must not try each split of the text.
+PARENT_REGEX = r'\([^()]*(?:%s[^()]*)?\)' % SUBPARENT_REGEX
 IMPORT_GROUP_REGEX = re.compile(r"^(?:import|from) .*\n(?:(?:import|from) .*\n)*\n*",
                                 re.MULTILINE)
 IMPORT_NAME_REGEX = re.compile(r"^(?:import|from) (%s)" % IDENTIFIER_REGEX,
                                re.MULTILINE)
+NEWLINE_REGEX = re.compile('\n')
+
+# Line boundaries of str.splitlines()
+LINE_BREAK_REGEX = re.compile('\r\n|[\n\r\v\f\x1c-\x1e\x85\u2028\u2029]')
+IMPORT_LINE_REGEX = re.compile(r"^(?:import|from) .*", re.MULTILINE)
 # 'abc', 'sym1, sym2'
 FROM_IMPORT_SYMBOLS_REGEX = r"%s(?:, %s)*" % (IDENTIFIER_REGEX, IDENTIFIER_REGEX)
 
@@ -158,6 +291,148 @@ def parse_import_groups(content):
     return import_groups
 
 
+class _ImportGroup:
+    def __init__(self, start, end, lines, imports, prefix=''):
+        # start:end is the text of the original content replaced by the
+        # group, prefix is text written before the lines of the group
+        self.start = start
+        self.end = end
+        self.lines = lines
+        self.imports = imports
+        self.prefix = prefix
+
+
+class ImportTable:
+    """Import groups of a content, parsed once.
+
+    Lines are added to the groups as the content would be modified by
+    inserting them one by one, and parsed again: render() builds the new
+    content. The text outside import groups is never modified.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.groups = [_ImportGroup(start, end,
+                                    _split_lines(content[start:end]), imports)
+                       for start, end, imports
+                       in parse_import_groups(content)]
+        # Import lines without trailing spaces and comment: see has_line()
+        self._lines = None
+
+    @staticmethod
+    def _line_key(line):
+        return line.split('#', 1)[0].rstrip(' ')
+
+    @staticmethod
+    def _import_name(line):
+        match = IMPORT_NAME_REGEX.match(line)
+        return match.group(1) if match is not None else None
+
+    def has_line(self, line):
+        """Check if the content has the line, followed by optional spaces
+        and comment."""
+        if self._lines is None:
+            self._lines = set(self._line_key(match.group())
+                              for match in IMPORT_LINE_REGEX.finditer(
+                                  self.content))
+            for group in self.groups:
+                self._lines.update(self._line_key(line.rstrip('\n'))
+                                   for line in group.lines)
+        return line in self._lines
+
+    def _added(self, group, line):
+        name = self._import_name(line)
+        if name is not None:
+            group.imports.add(name)
+        if self._lines is not None:
+            self._lines.add(self._line_key(line.rstrip('\n')))
+
+    def _tail(self, index, include_lines):
+        # Get the last 2 characters before the lines of the group index, or
+        # after the lines if include_lines is true
+        tail = ''
+        while True:
+            group = self.groups[index]
+            if include_lines:
+                tail = ''.join(group.lines[-2:]) + tail
+                if len(tail) >= 2:
+                    return tail[-2:]
+            tail = group.prefix + tail
+            if len(tail) >= 2:
+                return tail[-2:]
+            prev_end = self.groups[index - 1].end if index else 0
+            tail = self.content[max(prev_end, group.start - 2):group.start] + tail
+            if len(tail) >= 2 or not index:
+                return tail[-2:]
+            if prev_end < group.start - 2:
+                return tail[-2:]
+            index -= 1
+            include_lines = True
+
+    def add_first_group(self, line):
+        """Add the first import group, the content has no import group."""
+        content = self.content
+        if content:
+            # Blank lines at the start of the content become part of the
+            # group
+            end = len(content) - len(content.lstrip('\n'))
+            lines = [line, '\n', '\n'] + ['\n'] * end
+        else:
+            end = 0
+            lines = [line]
+        group = _ImportGroup(0, end, lines, set())
+        self.groups.append(group)
+        self._added(group, line)
+
+    def add_group(self, index, after, line):
+        """Add a new import group before the group index, or after it if
+        after is true."""
+        tail = self._tail(index, after)
+        if not tail or tail.endswith('\n\n'):
+            newline1 = ''
+        else:
+            newline1 = '\n'
+        group = self.groups[index]
+        if after:
+            blank_lines = ['\n', '\n']
+            if newline1:
+                # the blank line becomes part of the previous group
+                group.lines.append(newline1)
+            new_group = _ImportGroup(group.end, group.end,
+                                     [line] + blank_lines, set())
+            self.groups.insert(index + 1, new_group)
+        else:
+            new_group = _ImportGroup(group.start, group.start, [line, '\n'],
+                                     set(), group.prefix + newline1)
+            group.prefix = ''
+            self.groups.insert(index, new_group)
+        self._added(new_group, line)
+
+    def insert_line(self, index, pos, line):
+        """Insert a line in the group index at the line number pos."""
+        group = self.groups[index]
+        group.lines.insert(pos, line)
+        self._added(group, line)
+
+    def render(self):
+        parts = []
+        pos = 0
+        for group in self.groups:
+            parts.append(self.content[pos:group.start])
+            parts.append(group.prefix)
+            parts.extend(group.lines)
+            pos = group.end
+        parts.append(self.content[pos:])
+        return ''.join(parts)
+
+
+def line_starts(content):
+    """Get the offsets of the lines of content, as split by str.splitlines()."""
+    starts = [0]
+    starts.extend(match.end() for match in LINE_BREAK_REGEX.finditer(content))
+    return starts
+
+
 def parse_import(line):
     line = line.strip()
     if line.startswith("import "):
@@ -177,32 +452,757 @@ def get_line(content, pos):
     return content[pos:eol + 1]
 
 
+class EditConflict(Exception):
+    pass
+
+
+class FileTimeout(Exception):
+    """Patching a file took longer than the --file-timeout budget."""
+
+    def __init__(self, filename, timeout, operation):
+        super().__init__(filename, timeout, operation)
+        self.filename = filename
+        self.timeout = timeout
+        self.operation = operation
+
+    def __str__(self):
+        return ("%s: skipped, patching the file took longer than %s seconds "
+                "(stuck in %s)" % (self.filename, self.timeout,
+                                   self.operation or "unknown operation"))
+
+
+def apply_edits(content, edits):
+    """Apply (start, end, replacement) edits to content and return the new
+    content.
+
+    All edits are relative to content. Raise EditConflict if two edits
+    overlap.
+    """
+    edits = sorted(edits, key=lambda edit: (edit[0], edit[1]))
+    parts = []
+    pos = 0
+    for edit in edits:
+        start, end, replacement = edit
+        if start < pos:
+            raise EditConflict("edit %r overlaps the previous edit"
+                               % (tuple(edit),))
+        parts.append(content[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(content[pos:])
+    return ''.join(parts)
+
+
+def _common_affixes(old, new, chunk=4096):
+    # Get the length of the common prefix and of the common suffix of old
+    # and new, the suffix doesn't overlap the prefix
+    size = min(len(old), len(new))
+    prefix = 0
+    while prefix < size:
+        step = min(chunk, size - prefix)
+        if old[prefix:prefix + step] == new[prefix:prefix + step]:
+            prefix += step
+            continue
+        while old[prefix] == new[prefix]:
+            prefix += 1
+        break
+    size -= prefix
+    suffix = 0
+    while suffix < size:
+        step = min(chunk, size - suffix)
+        if (old[len(old) - suffix - step:len(old) - suffix]
+                == new[len(new) - suffix - step:len(new) - suffix]):
+            suffix += step
+            continue
+        while old[len(old) - suffix - 1] == new[len(new) - suffix - 1]:
+            suffix += 1
+        break
+    return prefix, suffix
+
+
+def decode_source(data):
+    """Decode Python source code as tokenize.open() does: detect the encoding
+    and translate newlines to "\\n".
+
+    Return (content, encoding, newline) where newline is the first newline
+    sequence of data ("\\n" if data has no newline).
+    """
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    content = data.decode(encoding)
+
+    newline = "\n"
+    pos = data.find(b"\r")
+    if pos >= 0:
+        eol = data.find(b"\n", 0, pos)
+        if eol < 0:
+            newline = "\r\n" if data[pos + 1:pos + 2] == b"\n" else "\r"
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content, encoding, newline
+
+
+# Encodings which are ASCII compatible: cache of is_ascii_compatible()
+_ASCII_COMPATIBLE = {}
+
+
+def is_ascii_compatible(encoding):
+    """Check if ASCII characters are encoded as ASCII bytes by encoding."""
+    result = _ASCII_COMPATIBLE.get(encoding)
+    if result is None:
+        sample = bytes(range(128))
+        try:
+            data = sample.decode('ascii').encode(encoding)
+        except UnicodeError:
+            data = b''
+        # utf-8-sig writes a BOM
+        result = data in (sample, codecs.BOM_UTF8 + sample)
+        _ASCII_COMPATIBLE[encoding] = result
+    return result
+
+
+def encode_source(content, encoding, newline):
+    """Encode Python source code: the reverse of decode_source()."""
+    if newline != "\n":
+        content = content.replace("\n", newline)
+    return content.encode(encoding)
+
+
+def _split_lines(text):
+    # Split text at "\n" characters, keep line ends
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _line_spans(old, new, start, old_end, new_end, lookahead=100):
+    # Compare the lines of old[start:old_end] and new[start:new_end] and
+    # return (start, end, length) spans of old replaced with length
+    # characters. Lines are resynchronized using a bounded lookahead, so the
+    # comparison is linear but the spans are not always minimal.
+    old_lines = _split_lines(old[start:old_end])
+    new_lines = _split_lines(new[start:new_end])
+    spans = []
+    old_pos = new_pos = start
+    i = j = 0
+    while i < len(old_lines) and j < len(new_lines):
+        if old_lines[i] == new_lines[j]:
+            old_pos += len(old_lines[i])
+            new_pos += len(new_lines[j])
+            i += 1
+            j += 1
+            continue
+
+        index = {}
+        for y in range(j, min(j + lookahead, len(new_lines))):
+            index.setdefault(new_lines[y], y)
+        best = None
+        for x in range(i, min(i + lookahead, len(old_lines))):
+            if best is not None and x - i >= best[0] - i + best[1] - j:
+                break
+            y = index.get(old_lines[x])
+            if y is None:
+                continue
+            if best is None or (x - i) + (y - j) < (best[0] - i) + (best[1] - j):
+                best = (x, y)
+        if best is None:
+            best = (min(i + lookahead, len(old_lines)),
+                    min(j + lookahead, len(new_lines)))
+
+        old_size = sum(map(len, old_lines[i:best[0]]))
+        new_size = sum(map(len, new_lines[j:best[1]]))
+        spans.append(_narrow_span(old, new, old_pos, old_pos + old_size,
+                                  new_pos, new_pos + new_size))
+        old_pos += old_size
+        new_pos += new_size
+        i, j = best
+    if old_pos < old_end or new_pos < new_end:
+        spans.append(_narrow_span(old, new, old_pos, old_end,
+                                  new_pos, new_end))
+    return spans
+
+
+def _narrow_span(old, new, old_start, old_end, new_start, new_end):
+    # Remove the common prefix and suffix of old[old_start:old_end] and
+    # new[new_start:new_end]
+    prefix, suffix = _common_affixes(old[old_start:old_end],
+                                     new[new_start:new_end])
+    return (old_start + prefix, old_end - suffix,
+            new_end - new_start - prefix - suffix)
+
+
+def _diff_blocks(old, new, changes):
+    # Expand changed regions to full lines: return sorted
+    # [old_start, old_end, new_start, new_end] blocks of lines
+    blocks = []
+    for old_start, old_end, new_start, new_end, _ in changes:
+        old_a = old.rfind("\n", 0, old_start) + 1
+        new_a = new_start - (old_start - old_a)
+        if blocks and (old_a <= blocks[-1][1] or new_a <= blocks[-1][3]
+                       or (new_a and new[new_a - 1] != "\n")):
+            # merge with the previous block if they are contiguous or if the
+            # text before the change was modified by the previous change
+            block = blocks.pop()
+            old_a = block[0]
+            new_a = block[2]
+
+        if ((old_end == 0 or old[old_end - 1] == "\n")
+                and (new_end == 0 or new[new_end - 1] == "\n")):
+            extend = 0
+        else:
+            eol = old.find("\n", old_end)
+            if eol < 0:
+                extend = len(old) - old_end
+            else:
+                extend = eol + 1 - old_end
+        blocks.append([old_a, old_end + extend, new_a, new_end + extend])
+    return blocks
+
+
+def _diff_lines(prefix, lines, output, newline):
+    for line in lines:
+        if not line.endswith("\n"):
+            output.append(prefix + line)
+            output.append("\n\\ No newline at end of file\n")
+        elif newline != "\n":
+            output.append(prefix + line[:-1] + newline)
+        else:
+            output.append(prefix + line)
+
+
+def unified_diff(filename, old, new, changes, context=3, newline="\n",
+                 encoding=None):
+    """Format a unified diff of old and new content from the changed
+    regions of FileJob.changes.
+
+    newline and encoding are the newline sequence and the encoding of the
+    file (see decode_source()). The UTF-8 BOM removed by the "utf-8-sig"
+    codec is written back at the start of the first line, so the diff
+    applies to the file.
+
+    Only lines of changed regions are compared: the cost is linear in the
+    size of the content.
+    """
+    blocks = _diff_blocks(old, new, changes)
+    if not blocks:
+        return ''
+
+    old_lines = _split_lines(old)
+    line_starts = [0]
+    line_starts.extend(itertools.accumulate(map(len, old_lines)))
+    bom = (encoding == "utf-8-sig")
+    if bom and old_lines:
+        old_lines[0] = "\ufeff" + old_lines[0]
+
+    # Group blocks in hunks: [first_line, last_line, blocks] where
+    # first_line:last_line is the old lines range of the hunk
+    hunks = []
+    for block in blocks:
+        first = bisect.bisect_right(line_starts, block[0]) - 1
+        last = bisect.bisect_left(line_starts, block[1])
+        new_lines = _split_lines(new[block[2]:block[3]])
+        if bom and block[2] == 0 and new_lines:
+            new_lines[0] = "\ufeff" + new_lines[0]
+        block_lines = (first, last, new_lines)
+        if hunks and first - context <= hunks[-1][1] + context:
+            hunks[-1][1] = last
+            hunks[-1][2].append(block_lines)
+        else:
+            hunks.append([first, last, [block_lines]])
+
+    path = filename
+    if os.path.isabs(path):
+        path = os.path.relpath(path)
+    path = os.path.normpath(path).replace(os.sep, "/")
+    output = ["--- a/%s\n" % path, "+++ b/%s\n" % path]
+    delta = 0
+    for first, last, hunk_blocks in hunks:
+        start = max(first - context, 0)
+        end = min(last + context, len(old_lines))
+        lines = []
+        pos = start
+        old_count = end - start
+        new_count = old_count
+        for block_first, block_last, new_block in hunk_blocks:
+            _diff_lines(" ", old_lines[pos:block_first], lines, newline)
+            _diff_lines("-", old_lines[block_first:block_last], lines,
+                        newline)
+            _diff_lines("+", new_block, lines, newline)
+            new_count += len(new_block) - (block_last - block_first)
+            pos = block_last
+        _diff_lines(" ", old_lines[pos:end], lines, newline)
+
+        old_line = start + 1 if old_count else start
+        new_line = start + delta + 1 if new_count else start + delta
+        output.append("@@ -%s,%s +%s,%s @@\n"
+                      % (old_line, old_count, new_line, new_count))
+        output.extend(lines)
+        delta += new_count - old_count
+    return ''.join(output)
+
+
+class CodeMask:
+    """Regions of the strings and comments of a source code.
+
+    The regions are found using the tokenize module. They are sorted and
+    don't overlap, a position is looked up using bisect. If the code cannot
+    be tokenized, regions after the error are unknown and considered as
+    code.
+    """
+
+    def __init__(self, content):
+        self.starts = []
+        self.ends = []
+        lines = [0]
+        lines.extend(match.end() for match in re.finditer('\n', content))
+        readline = io.StringIO(content).readline
+        try:
+            for token in tokenize.generate_tokens(readline):
+                if token.type not in (tokenize.STRING, tokenize.COMMENT):
+                    continue
+                self.starts.append(lines[token.start[0] - 1] + token.start[1])
+                self.ends.append(lines[token.end[0] - 1] + token.end[1])
+        except (tokenize.TokenError, SyntaxError):
+            # ex: unclosed bracket, inconsistent indentation
+            pass
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_code(self, pos):
+        """Check if pos is outside strings and comments."""
+        index = bisect.bisect_right(self.starts, pos) - 1
+        return index < 0 or pos >= self.ends[index]
+
+
+class OperationStats:
+    """Counters of an operation: see Patcher.stats.
+
+    patch_time and check_time are the time spent in seconds to patch and
+    check files, files is the number of patched files, matches the number of
+    replacements (the number of changed regions for operations which only
+    implement patch()), imports the number of added import lines and chars
+    the number of characters of the scanned contents.
+    """
+    FIELDS = ('patch_time', 'check_time', 'files', 'matches', 'imports',
+              'chars')
+
+    def __init__(self):
+        self.patch_time = 0.0
+        self.check_time = 0.0
+        self.files = 0
+        self.matches = 0
+        self.imports = 0
+        self.chars = 0
+
+    def __repr__(self):
+        return ('<OperationStats %s>'
+                % ' '.join('%s=%s' % (field, getattr(self, field))
+                           for field in self.FIELDS))
+
+    def add(self, other):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+
+class WarningMessage(str):
+    """Message of a warning emitted on a file.
+
+    The string is the displayed message. The location of the warning is
+    stored in attributes: filename; lineno and column, starting at 1, in the
+    patched content (None if the warning is not about a line); operation,
+    the name of the operation which emitted the warning (None if the warning
+    comes from the Patcher). text is the message without the operation name
+    and the filename (ex: the suspicious line).
+    """
+
+    def __new__(cls, message, filename=None, lineno=None, column=None,
+                operation=None, text=None):
+        self = str.__new__(cls, message)
+        self.filename = filename
+        self.lineno = lineno
+        self.column = column
+        self.operation = operation
+        self.text = text if text is not None else message
+        return self
+
+    @property
+    def location(self):
+        return (self.filename, self.lineno, self.column, self.operation)
+
+
+def _location(newlines, pos):
+    # Get the (lineno, column) of pos from the sorted offsets of newline
+    # characters
+    index = bisect.bisect_left(newlines, pos)
+    line_start = newlines[index - 1] + 1 if index else 0
+    return (index + 1, pos - line_start + 1)
+
+
+class FileJob:
+    """Per-file state of a Patcher: the patched file, its content, the names
+    of the applied operations and the emitted warnings.
+
+    Operations store their per-file state in the job, so one Patcher can
+    patch multiple files concurrently.
+
+    changes is the sorted list of the changed regions: [old_start, old_end,
+    new_start, new_end, owners] where old_start:old_end is the region in
+    the original content, new_start:new_end the region in the current
+    content and owners the set of names of the operations which modified
+    the region.
+    """
+
+    def __init__(self, filename, content=None):
+        self.filename = filename
+        self.content = content
+        # Encoding and newline sequence of the file (see decode_source())
+        self.encoding = "utf-8"
+        self.newline = "\n"
+        self.original = content
+        self.changes = []
+        self.warnings = []
+        self.applied_operations = set()
+        # ResultCache key and lookup result: None if the cache is not used
+        self.cache_key = None
+        self.cache_hit = None
+        # RegexCache hits and misses of a worker process (Patcher.main())
+        self.regex_hits = 0
+        self.regex_misses = 0
+        # CodeMask of the original content, built on demand by is_code()
+        self.code_mask = None
+        # Time spent to build the code mask in seconds
+        self.code_mask_time = 0.0
+        # Offsets of newline characters of _newlines_content
+        self._newlines = None
+        self._newlines_content = None
+        # (operation, lineno, column, old, new) of replaced matches, only
+        # recorded if Patcher.record_replacements is true
+        self.replacements = []
+        # Offsets of newline characters of the original content
+        self._original_newlines = None
+        # OperationStats per operation name
+        self.stats = {}
+        # Number of import lines added to the content
+        self.imports_added = 0
+        # Time spent in Patcher.patch_file() in seconds
+        self.elapsed = 0.0
+
+    @property
+    def modified(self):
+        return bool(self.applied_operations)
+
+    def is_code(self, pos):
+        """Check if the position pos of the current content is code.
+
+        Strings and comments are found in the original content, the position
+        is mapped to the original content using changes. Text written by
+        operations is considered as code.
+        """
+        if self.code_mask is None:
+            start_time = time.perf_counter()
+            self.code_mask = CodeMask(self.original)
+            self.code_mask_time += time.perf_counter() - start_time
+        pos, written = self.original_position(pos)
+        if written:
+            return True
+        return self.code_mask.is_code(pos)
+
+    def original_position(self, pos):
+        """Map the position pos of the current content to the original
+        content using changes.
+
+        Return (pos, written): written is true if pos is in text written by
+        an operation, pos is then the start of the changed region in the
+        original content.
+        """
+        # Find the last change starting before pos using a binary search
+        changes = self.changes
+        low = 0
+        high = len(changes)
+        while low < high:
+            middle = (low + high) // 2
+            if changes[middle][2] <= pos:
+                low = middle + 1
+            else:
+                high = middle
+        if low:
+            change = changes[low - 1]
+            if pos < change[3]:
+                return (change[0], True)
+            pos = change[1] + (pos - change[3])
+        return (pos, False)
+
+    def set_content(self, content):
+        """Make content the current content: record the changes between
+        the previous current content and content.
+
+        Used by operations modifying the content in multiple steps, so
+        is_code() gets positions of the intermediate content.
+        """
+        if content is not self.content:
+            self.record_content(self.content, content)
+            self.content = content
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+    def operation_stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = OperationStats()
+        return stats
+
+    def newline_index(self):
+        """Get the array of the offsets of newline characters of content.
+
+        The array is only built once per content.
+        """
+        content = self.content
+        if self._newlines_content is not content:
+            self._newlines = array.array('I', [
+                match.start() for match in NEWLINE_REGEX.finditer(content)])
+            self._newlines_content = content
+        return self._newlines
+
+    def location(self, pos):
+        """Get the (lineno, column) of the position pos of content, starting
+        at 1."""
+        return _location(self.newline_index(), pos)
+
+    def add_replacement(self, operation, pos, old, new):
+        """Record that an operation replaced the text old at the position
+        pos of the current content with new.
+
+        The line and column numbers are located in the original content.
+        """
+        pos = self.original_position(pos)[0]
+        if self._original_newlines is None:
+            self._original_newlines = array.array('I', [
+                match.start()
+                for match in NEWLINE_REGEX.finditer(self.original)])
+        lineno, column = _location(self._original_newlines, pos)
+        self.replacements.append((operation, lineno, column, old, new))
+
+    def record_edits(self, edits, owner=None):
+        """Record edits applied on the current content.
+
+        edits is a list of (start, end, replacement) tuples relative to the
+        current content, as passed to apply_edits().
+
+        Operations are applied one after the other: an edit can rewrite text
+        written by a previous operation, its region is merged with the
+        previous change.
+        """
+        spans = [(edit[0], edit[1], len(edit[2]), owner) for edit in edits]
+        spans.sort(key=lambda span: (span[0], span[1]))
+        self._compose(spans)
+
+    def record_content(self, old, new, owner=None):
+        """Record that the current content old was replaced with new."""
+        if old == new:
+            return
+        prefix, suffix = _common_affixes(old, new)
+        start = old.rfind("\n", 0, prefix) + 1
+        spans = [(span_start, span_end, length, owner)
+                 for span_start, span_end, length
+                 in _line_spans(old, new, start,
+                                len(old) - suffix, len(new) - suffix)]
+        self._compose(spans)
+        return len(spans)
+
+    def _compose(self, spans):
+        # Merge the changes with sorted non-overlapping spans (start, end,
+        # length, owner) of the current content
+        items = [(change[2], 0, change[3], change) for change in self.changes]
+        items.extend((span[0], 1, span[1], span) for span in spans)
+        items.sort(key=lambda item: (item[0], item[2], item[1]))
+
+        changes = []
+        # delta: current position - original position of unchanged text
+        delta = 0
+        # shift: new position - current position of unchanged text
+        shift = 0
+        index = 0
+        while index < len(items):
+            start = items[index][0]
+            end = items[index][2]
+            cluster = []
+            while index < len(items) and (not cluster
+                                          or items[index][0] < end):
+                cluster.append(items[index])
+                end = max(end, items[index][2])
+                index += 1
+
+            old_start = start - delta
+            owners = set()
+            cluster_shift = 0
+            for item in cluster:
+                if item[1]:
+                    span = item[3]
+                    cluster_shift += span[2] - (span[1] - span[0])
+                    if span[3] is not None:
+                        owners.add(span[3])
+                else:
+                    change = item[3]
+                    delta += (change[3] - change[2]) - (change[1] - change[0])
+                    owners |= change[4]
+            old_end = end - delta
+
+            changes.append([old_start, old_end,
+                            start + shift, end + shift + cluster_shift,
+                            owners])
+            shift += cluster_shift
+        self.changes = changes
+
+
 class Operation:
     NAME = "<name>"
     DOC = "<doc>"
 
+    # Substrings which are part of every text that patch() modifies and of
+    # every line that check() warns about. Patcher skips the operation on
+    # contents which don't contain any trigger. None means that the
+    # operation is always run.
+    TRIGGERS = None
+
     def __init__(self, patcher):
         self.patcher = patcher
         self.options = patcher.options
 
-    def patch(self, content):
+    def patch(self, job, content):
         raise NotImplementedError
 
-    def check(self, content):
+    def edits(self, job, content):
+        """Get the list of (start, end, replacement) edits of content.
+
+        Return None if the operation only implements patch(). Patcher
+        applies the edits with apply_edits() and then calls post_patch() if
+        the list is not empty.
+        """
+        return None
+
+    def post_patch(self, job, content):
+        # Called when edits modified the content
+        return content
+
+    def sub(self, job, regex, repl, content):
+        """Replace matches of regex in content with repl, as
+        regex.sub(repl, content) does.
+
+        With --code-only, matches in strings and comments are not replaced.
+        Replaced matches are counted in the operation statistics.
+        """
+        code_only = self.patcher.code_only
+        record = self.patcher.record_replacements
+        if code_only or record:
+            job.set_content(content)
+        stats = job.operation_stats(self.NAME)
+
+        def replace(match):
+            text = match.group()
+            if code_only and not job.is_code(match.start()):
+                return text
+            if callable(repl):
+                new_text = repl(match)
+            else:
+                new_text = match.expand(repl)
+            if new_text != text:
+                stats.matches += 1
+                if record:
+                    job.add_replacement(self.NAME, match.start(), text,
+                                        new_text)
+            return new_text
+
+        return regex.sub(replace, content)
+
+    def check(self, job, content, lines=None):
+        """Warn about suspicious code which may have to be ported manually.
+
+        lines is the sorted list of the (start, end) ranges of the lines of
+        content to check, without the newline character, or None to check
+        all lines. Patcher.check() only passes lines containing a trigger.
+        """
         raise NotImplementedError
 
-    def warning(self, message):
+    def iter_check_matches(self, regex, content, lines):
+        # Iterate on matches of regex on lines. regex must only match at
+        # the start of a line ('^' with re.MULTILINE).
+        if lines is None:
+            yield from regex.finditer(content)
+            return
+        end = 0
+        for start, line_end in lines:
+            if start < end:
+                # the line is part of the previous match
+                continue
+            match = regex.match(content, start)
+            if match is not None:
+                end = match.end()
+                yield match
+
+    def iter_check_lines(self, content, lines):
+        # Iterate on (pos, line) of lines, split by str.splitlines()
+        if lines is None:
+            lines = ((0, len(content)),)
+        for start, end in lines:
+            pos = start
+            for line in content[start:end].splitlines(True):
+                yield (pos, line.splitlines()[0])
+                pos += len(line)
+
+    def warning(self, job, message, pos=None):
+        # pos is a position in job.content
+        text = message
         message = ("[%s] %s: %s"
-                   % (self.NAME, self.patcher.current_file, message))
-        self.patcher.warning(message)
+                   % (self.NAME, job.filename, text))
+        if pos is not None:
+            lineno, column = job.location(pos)
+        else:
+            lineno = column = None
+        job.warning(WarningMessage(message, job.filename, lineno, column,
+                                   self.NAME, text))
 
-    def warn_line(self, line):
-        self.warning(line.strip())
+    def warn_line(self, job, line, pos=None):
+        # pos is the position of the line in job.content
+        if pos is not None:
+            pos += len(line) - len(line.lstrip())
+        self.warning(job, line.strip(), pos)
+
+
+class SubOperation(Operation):
+    """Operation replacing matches of the REGEX regular expression with the
+    result of the replace() method.
+    """
+    REGEX = None
+
+    def replace(self, regs):
+        raise NotImplementedError
+
+    def edits(self, job, content):
+        code_only = self.patcher.code_only
+        edits = []
+        for match in self.REGEX.finditer(content):
+            if code_only and not job.is_code(match.start()):
+                continue
+            replacement = self.replace(match)
+            if replacement != match.group():
+                edits.append((match.start(), match.end(), replacement))
+        return edits
+
+    def patch(self, job, content):
+        edits = self.edits(job, content)
+        if not edits:
+            return content
+        return self.post_patch(job, apply_edits(content, edits))
 
 
-class Iteritems(Operation):
+class Iteritems(SubOperation):
     NAME = "iteritems"
     DOC = "replace dict.iteritems() with six.iteritems(dict)"
+    TRIGGERS = ("iteritems",)
 
     REGEX = re.compile(r"(%s)\.iteritems\(\)" % EXPR_REGEX)
     CHECK_REGEX = re.compile(r"^.*\biteritems *\(.*$", re.MULTILINE)
@@ -210,22 +1210,21 @@ class Iteritems(Operation):
     def replace(self, regs):
         return 'six.iteritems(%s)' % regs.group(1)
 
-    def patch(self, content):
-        new_content = self.REGEX.sub(self.replace, content)
-        if new_content == content:
-            return content
-        return self.patcher.add_import_six(new_content)
+    def post_patch(self, job, content):
+        return self.patcher.add_import_six(content, job)
 
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
             line = match.group(0)
             if "six.iteritems" not in line:
-                self.warn_line(line)
+                self.warn_line(job, line, match.start())
 
 
-class Itervalues(Operation):
+class Itervalues(SubOperation):
     NAME = "itervalues"
     DOC = "replace dict.itervalues() with six.itervalues(dict)"
+    TRIGGERS = ("itervalues",)
 
     REGEX = re.compile(r"(%s)\.itervalues\(\)" % EXPR_REGEX)
     CHECK_REGEX = re.compile(r"^.*\bitervalues *\(.*$", re.MULTILINE)
@@ -233,22 +1232,21 @@ class Itervalues(Operation):
     def replace(self, regs):
         return 'six.itervalues(%s)' % regs.group(1)
 
-    def patch(self, content):
-        new_content = self.REGEX.sub(self.replace, content)
-        if new_content == content:
-            return content
-        return self.patcher.add_import_six(new_content)
+    def post_patch(self, job, content):
+        return self.patcher.add_import_six(content, job)
 
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
             line = match.group(0)
             if "six.itervalues" not in line:
-                self.warn_line(line)
+                self.warn_line(job, line, match.start())
 
 
-class HasKey(Operation):
+class HasKey(SubOperation):
     NAME = "has_key"
     DOC = "replace dict.has_key(key) with 'key in dict'"
+    TRIGGERS = ("has_key",)
 
     REGEX = re.compile(r"(%s)\.has_key\((%s)\)" % (EXPR_REGEX, EXPR_REGEX))
     CHECK_REGEX = re.compile(r"^.*\.has_key", re.MULTILINE)
@@ -256,20 +1254,19 @@ class HasKey(Operation):
     def replace(self, regs):
         return '%s in %s' % (regs.group(2), regs.group(1))
 
-    def patch(self, content):
-        return self.REGEX.sub(self.replace, content)
-
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
             line = match.group(0)
             if "six.iterkeys" not in line:
-                self.warn_line(line)
+                self.warn_line(job, line, match.start())
 
 
 class Iterkeys(Operation):
     NAME = "iterkeys"
     DOC = ("replace 'for key in dict.iterkeys():' with 'for key in dict:',"
            "replace dict.iterkeys() with six.iterkeys(dict)")
+    TRIGGERS = ("iterkeys",)
 
     FOR_REGEX = re.compile(r"(for %s in %s)\.iterkeys\(\):"
                            % (EXPR_REGEX, EXPR_REGEX))
@@ -282,23 +1279,25 @@ class Iterkeys(Operation):
     def replace(self, regs):
         return 'six.iterkeys(%s)' % regs.group(1)
 
-    def patch(self, content):
-        content = self.FOR_REGEX.sub(self.replace_for, content)
-        new_content = self.REGEX.sub(self.replace, content)
+    def patch(self, job, content):
+        content = self.sub(job, self.FOR_REGEX, self.replace_for, content)
+        new_content = self.sub(job, self.REGEX, self.replace, content)
         if new_content != content:
-            content = self.patcher.add_import_six(new_content)
+            content = self.patcher.add_import_six(new_content, job)
         return content
 
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
             line = match.group(0)
             if "six.iterkeys" not in line:
-                self.warn_line(line)
+                self.warn_line(job, line, match.start())
 
 
-class Next(Operation):
+class Next(SubOperation):
     NAME = "next"
     DOC = "replace it.next() with next(it)"
+    TRIGGERS = ("next",)
 
     # Match 'gen.next()' and '(...).next()'
     REGEX = re.compile(r"(%s|%s)\.next\(\)" % (EXPR_REGEX, PARENT_REGEX))
@@ -315,14 +1314,14 @@ class Next(Operation):
             expr = expr[1:-1]
         return 'next(%s)' % expr
 
-    def patch(self, content):
-        return self.REGEX.sub(self.replace, content)
-
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
-            self.warn_line(match.group(0))
-        for match in self.DEF_NEXT_LINE_REGEX.finditer(content):
-            self.warn_line(match.group(0))
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
+            self.warn_line(job, match.group(0), match.start())
+        matches = self.iter_check_matches(self.DEF_NEXT_LINE_REGEX, content,
+                                          lines)
+        for match in matches:
+            self.warn_line(job, match.group(0), match.start())
 
 
 class Long(Operation):
@@ -330,6 +1329,10 @@ class Long(Operation):
     DOC = ("replace 123L with 123, "
            "replace (int, long) with six.integer_types, "
            "replace long(1) with 1")
+    # '123L', '0123L', '0xFFL', 'long(1)', '(int, long)'
+    TRIGGERS = (("long", "0x")
+                + tuple(digit + suffix
+                        for digit in "0123456789" for suffix in "lL"))
 
     # (int, long)
     INT_LONG_REGEX = re.compile(r'\(int, *long\)')
@@ -355,91 +1358,138 @@ class Long(Operation):
     def replace_long_int(self, regs):
         return regs.group(1)
 
-    def patch(self, content):
-        content = self.REGEX_INT_L.sub(self.replace_int_l, content)
-        content = self.OCTAL_REGEX.sub(self.replace_octal, content)
-        content = self.LONG_INT_REGEX.sub(self.replace_long_int, content)
-        new_content = self.INT_LONG_REGEX.sub('six.integer_types', content)
+    def patch(self, job, content):
+        content = self.sub(job, self.REGEX_INT_L, self.replace_int_l, content)
+        content = self.sub(job, self.OCTAL_REGEX, self.replace_octal, content)
+        content = self.sub(job, self.LONG_INT_REGEX, self.replace_long_int,
+                           content)
+        new_content = self.sub(job, self.INT_LONG_REGEX, 'six.integer_types',
+                               content)
         if new_content != content:
-            content = self.patcher.add_import_six(new_content)
+            content = self.patcher.add_import_six(new_content, job)
         return content
 
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
-            self.warn_line(match.group(0))
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
+            self.warn_line(job, match.group(0), match.start())
 
 
 class Unicode(Operation):
     NAME = "unicode"
     DOC = ("replace unicode with six.text_type,"
            "replace (str, unicode) with six.string_types")
+    TRIGGERS = ("unicode",)
 
     UNICODE_REGEX = re.compile(r'\bunicode\b')
 
     STR_UNICODE_REGEX = re.compile(r'\(str, *unicode\)')
 
-    DEF_REGEX = re.compile(r'^ *def +%s *\(' % IDENTIFIER_REGEX, re.MULTILINE)
-
-    def _patch_line(self, line, start, end):
-        result = None
-        while True:
-            match = self.UNICODE_REGEX.search(line, start, end)
-            if not match:
-                return result
-            line = line[:match.start()] + "six.text_type" + line[match.end():]
-            result = line
-            start = match.start() + len("six.text_type")
-            end += len("six.text_type") - len("unicode")
+    # 'def unicode(', matched at the start of a line
+    DEF_REGEX = re.compile(r' *def +%s *\(' % IDENTIFIER_REGEX)
+
+    def _line_bounds(self, content, line_start, line_end, replaced):
+        # Get the range of the line where unicode can be replaced.
+        # Ugly heuristic to exclude "import ...", "from ... import ...",
+        # function name in "def ...(", comments and strings
+        # declared with """
+        if content.startswith(("import ", "from "), line_start):
+            return None
+        start = line_start
+        end = content.find("#", line_start, line_end)
+        if end < 0:
+            end = line_end
+
+        pos = content.find('"""', start, end)
+        if pos != -1:
+            end = pos
+
+        match = self.DEF_REGEX.match(content, start, end)
+        if match and match.end() - 1 not in replaced:
+            start = match.end()
+        return (start, end)
+
+    def unicode_edits(self, job, content, replaced=None):
+        # Get edits replacing unicode with six.text_type. replaced is a dict
+        # start => end of (str, unicode) replaced with six.string_types:
+        # unicode is then no longer a word if it's next to the replacement
+        matches = list(self.UNICODE_REGEX.finditer(content))
+        if not matches:
+            return []
+
+        code_only = self.patcher.code_only
+        if replaced is None:
+            replaced = {}
+        ends = set(replaced.values())
+        starts = line_starts(content)
+        edits = []
+        line = None
+        for match in matches:
+            index = bisect.bisect_right(starts, match.start()) - 1
+            if index != line:
+                line = index
+                if index + 1 < len(starts):
+                    line_end = starts[index + 1]
+                else:
+                    line_end = len(content)
+                bounds = self._line_bounds(content, starts[index], line_end,
+                                           replaced)
+            if bounds is None:
+                continue
+            if not (bounds[0] <= match.start() and match.end() <= bounds[1]):
+                continue
+            if (match.end() in replaced or match.start() in ends
+                    # unicode of (str, unicode)
+                    or match.end() + 1 in ends):
+                continue
+            if code_only and not job.is_code(match.start()):
+                continue
+            edits.append((match.start(), match.end(), "six.text_type"))
+        return edits
 
     def patch_unicode(self, content):
         # replace unicode with six.text_type
-        lines = content.splitlines(True)
-        for index, line in enumerate(lines):
-            # Ugly heuristic to exclude "import ...", "from ... import ...",
-            # function name in "def ...(", comments and strings
-            # declared with """
-            if line.startswith(("import ", "from ")):
+        edits = self.unicode_edits(None, content)
+        if not edits:
+            return content
+        return apply_edits(content, edits)
+
+    def edits(self, job, content):
+        code_only = self.patcher.code_only
+        edits = []
+        replaced = {}
+        for match in self.STR_UNICODE_REGEX.finditer(content):
+            if code_only and not job.is_code(match.start()):
                 continue
-            start = 0
-            end = line.find("#")
-            if end < 0:
-                end = len(line)
-
-            pos = line.find('"""', start, end)
-            if pos != -1:
-                end = pos
+            edits.append((match.start(), match.end(), 'six.string_types'))
+            replaced[match.start()] = match.end()
+        edits.extend(self.unicode_edits(job, content, replaced))
+        return edits
 
-            match = self.DEF_REGEX.search(line, start, end)
-            if match:
-                start = match.end()
-
-            new_line = self._patch_line(line, start, end)
-            if new_line is not None:
-                lines[index] = new_line
-        return ''.join(lines)
+    def post_patch(self, job, content):
+        return self.patcher.add_import_six(content, job)
 
-    def patch(self, content):
-        old_content = content
-        content = self.STR_UNICODE_REGEX.sub('six.string_types', content)
-        content = self.patch_unicode(content)
-        if content != old_content:
-            content = self.patcher.add_import_six(content)
-        return content
+    def patch(self, job, content):
+        edits = self.edits(job, content)
+        if not edits:
+            return content
+        return self.post_patch(job, apply_edits(content, edits))
 
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             end = line.find("#")
             if end >= 0:
                 match = self.UNICODE_REGEX.search(line, 0, end)
             else:
                 match = self.UNICODE_REGEX.search(line, 0)
             if match:
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
 class Xrange(Operation):
     NAME = "xrange"
     DOC = "replace xrange() with range() using 'from six import range'"
+    TRIGGERS = ("xrange",)
 
     # 'xrange(' but not 'moves.xrange(' or 'from six.moves import xrange'
     XRANGE_REGEX = re.compile("(?<!moves\.)xrange *\(")
@@ -448,7 +1498,7 @@ class Xrange(Operation):
     # 'xrange(1, 6)'
     XRANGE2_REGEX = re.compile(r"(?<!moves\.)xrange\(([0-9]+), ([0-9]+)\)")
 
-    def patch(self, content):
+    def patch(self, job, content):
         need_six = False
 
         def xrange1_replace(regs):
@@ -466,47 +1516,53 @@ class Xrange(Operation):
                 need_six = True
             return 'range(%s, %s)' % (start, end)
 
-        new_content = self.XRANGE1_REGEX.sub(xrange1_replace, content)
-        new_content = self.XRANGE2_REGEX.sub(xrange2_replace, new_content)
+        new_content = self.sub(job, self.XRANGE1_REGEX, xrange1_replace,
+                               content)
+        new_content = self.sub(job, self.XRANGE2_REGEX, xrange2_replace,
+                               new_content)
 
-        new_content2 = self.XRANGE_REGEX.sub("range(", new_content)
+        new_content2 = self.sub(job, self.XRANGE_REGEX, "range(", new_content)
         if new_content2 != new_content:
             need_six = True
         new_content = new_content2
 
         if need_six:
-            new_content = self.patcher.add_import(new_content, 'from six.moves import range')
+            new_content = self.patcher.add_import(new_content,
+                                                  'from six.moves import range', job)
         return new_content
 
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if self.XRANGE_REGEX.search(line):
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
-class Basestring(Operation):
+class Basestring(SubOperation):
     NAME = "basestring"
     DOC = "replace basestring with six.string_types"
+    TRIGGERS = ("basestring",)
 
     # match 'basestring' word
     BASESTRING_REGEX = re.compile(r"\bbasestring\b")
+    REGEX = BASESTRING_REGEX
 
-    def patch(self, content):
-        new_content = self.BASESTRING_REGEX.sub('six.string_types', content)
-        if new_content == content:
-            return content
-        return self.patcher.add_import_six(new_content)
+    def replace(self, regs):
+        return 'six.string_types'
 
-    def check(self, content):
-        for line in content.splitlines():
+    def post_patch(self, job, content):
+        return self.patcher.add_import_six(content, job)
+
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if 'basestring' in line:
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
 class StringIO(Operation):
     NAME = "stringio"
     DOC = ("replace StringIO.StringIO with six.StringIO"
            " and cStringIO.StringIO with six.moves.cStringIO")
+    TRIGGERS = ("StringIO",)
 
     # 'import StringIO'
     IMPORT_STRINGIO_REGEX = import_regex(r"StringIO")
@@ -523,75 +1579,89 @@ class StringIO(Operation):
     # 'import cStringIO as StringIO'
     IMPORT_CSTRINGIO_AS_REGEX = import_regex(r"cStringIO as StringIO")
 
+    # 'StringIO.StringIO'
+    STRINGIO_ATTR_REGEX = re.compile(r'StringIO\.StringIO')
+
+    # 'cStringIO.StringIO'
+    CSTRINGIO_ATTR_REGEX = re.compile(r'cStringIO\.StringIO')
+
     # 'StringIO.', 'cStringIO.', but not 'six.StringIO' or 'six.cStringIO'
     CSTRINGIO_REGEX = re.compile(r'(?<!six\.)\bc?StringIO\.')
 
-    def _patch_stringio1(self, content):
+    def _patch_stringio1(self, job, content):
         # Replace 'from StringIO import StringIO'
         # with 'from six import StringIO'
-        new_content = self.FROM_IMPORT_STRINGIO_REGEX.sub('', content)
+        new_content = self.sub(job, self.FROM_IMPORT_STRINGIO_REGEX, '', content)
         if new_content == content:
             return content
-        return self.patcher.add_import(new_content, 'from six import StringIO')
+        return self.patcher.add_import(new_content, 'from six import StringIO',
+                                       job)
 
-    def _patch_stringio2(self, content):
+    def _patch_stringio2(self, job, content):
         # Replace 'import StringIO' + 'StringIO.StringIO'
         # with 'import six' + 'six.StringIO'
-        new_content = self.IMPORT_STRINGIO_REGEX.sub('', content)
+        new_content = self.sub(job, self.IMPORT_STRINGIO_REGEX, '', content)
         if new_content == content:
             return content
 
-        new_content = self.patcher.add_import_six(new_content)
-        return new_content.replace("StringIO.StringIO", "six.StringIO")
+        new_content = self.patcher.add_import_six(new_content, job)
+        return self.sub(job, self.STRINGIO_ATTR_REGEX, "six.StringIO",
+                        new_content)
 
-    def _patch_cstringio1(self, content):
+    def _patch_cstringio1(self, job, content):
         # Replace 'from cStringIO import StringIO'
         # with 'from six.moves import cStringIO as StringIO'
-        new_content = self.FROM_IMPORT_CSTRINGIO_REGEX.sub('', content)
+        new_content = self.sub(job, self.FROM_IMPORT_CSTRINGIO_REGEX, '', content)
         if new_content == content:
             return content
 
         new_content = self.patcher.add_import(new_content,
-                                      "from six.moves import cStringIO as StringIO")
+                                      "from six.moves import cStringIO as StringIO",
+                                      job)
         return new_content
 
-    def _patch_cstringio2(self, content):
+    def _patch_cstringio2(self, job, content):
         # Replace 'import cStringIO' + 'cStringIO.StringIO'
         # with 'from six import moves' + 'moves.cStringIO'
-        new_content = self.IMPORT_CSTRINGIO_REGEX.sub('', content)
+        new_content = self.sub(job, self.IMPORT_CSTRINGIO_REGEX, '', content)
         if new_content == content:
             return content
 
-        new_content = self.patcher.add_import(new_content, "from six import moves")
-        return new_content.replace("cStringIO.StringIO", "moves.cStringIO")
+        new_content = self.patcher.add_import(new_content, "from six import moves",
+                                              job)
+        return self.sub(job, self.CSTRINGIO_ATTR_REGEX, "moves.cStringIO",
+                        new_content)
 
-    def _patch_cstringio3(self, content):
+    def _patch_cstringio3(self, job, content):
         # Replace 'import cStringIO as StringIO' + 'StringIO.StringIO'
         # with 'from six import moves' + 'moves.cStringIO'
-        new_content = self.IMPORT_CSTRINGIO_AS_REGEX.sub('', content)
+        new_content = self.sub(job, self.IMPORT_CSTRINGIO_AS_REGEX, '', content)
         if new_content == content:
             return content
 
-        new_content = self.patcher.add_import(new_content, "from six import moves")
-        return new_content.replace("StringIO.StringIO", "moves.cStringIO")
-
-    def patch(self, content):
-        content = self._patch_stringio1(content)
-        content = self._patch_stringio2(content)
-        content = self._patch_cstringio1(content)
-        content = self._patch_cstringio2(content)
-        content = self._patch_cstringio3(content)
+        new_content = self.patcher.add_import(new_content, "from six import moves",
+                                              job)
+        return self.sub(job, self.STRINGIO_ATTR_REGEX, "moves.cStringIO",
+                        new_content)
+
+    def patch(self, job, content):
+        content = self._patch_stringio1(job, content)
+        content = self._patch_stringio2(job, content)
+        content = self._patch_cstringio1(job, content)
+        content = self._patch_cstringio2(job, content)
+        content = self._patch_cstringio3(job, content)
         return content
 
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if 'StringIO.StringIO' in line or self.CSTRINGIO_REGEX.search(line):
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
 class Urllib(Operation):
     NAME = "urllib"
     DOC = "replace urllib, urllib2 and urlparse with six.moves.urllib"
+    TRIGGERS = ("urllib", "urlparse")
 
     # 'import urllib', 'import urllib2', 'import urlparse'
     IMPORT_URLLIB_REGEX = import_regex(r"\b(?:urllib2?|urlparse)\b")
@@ -655,7 +1725,7 @@ class Urllib(Operation):
     URLLIB_UNCHANGED = set('urllib.%s' % submodule
                            for submodule in SIX_MOVES_URLLIB)
 
-    def replace(self, regs):
+    def replace(self, job, regs):
         text = regs.group(0)
         if text in self.URLLIB_UNCHANGED:
             return text
@@ -666,7 +1736,7 @@ class Urllib(Operation):
         try:
             submodule = self.URLLIB[name]
         except KeyError:
-            self.warning("Unknown urllib symbol: %s" % text)
+            self.warning(job, "Unknown urllib symbol: %s" % text)
             return text
         return 'urllib.%s.%s' % (submodule, name)
 
@@ -693,41 +1763,41 @@ class Urllib(Operation):
             add_imports.add(line)
         return ''
 
-    def patch_import(self, content):
-        new_content = self.IMPORT_URLLIB_REGEX.sub('', content)
+    def patch_import(self, job, content):
+        new_content = self.sub(job, self.IMPORT_URLLIB_REGEX, '', content)
         if new_content == content:
             return content
         content = new_content
 
-        content = self.URLLIB_ATTR_REGEX.sub(self.replace, content)
+        replace_cb = functools.partial(self.replace, job)
+        content = self.sub(job, self.URLLIB_ATTR_REGEX, replace_cb, content)
         return self.patcher.add_import(content,
-                                       "from six.moves import urllib")
+                                       "from six.moves import urllib", job)
 
-    def patch_from_import(self, content, add_imports):
+    def patch_from_import(self, job, content, add_imports):
         replace_cb = functools.partial(self.replace_import_from, add_imports)
-        content = self.FROM_IMPORT_REGEX.sub(replace_cb, content)
+        content = self.sub(job, self.FROM_IMPORT_REGEX, replace_cb, content)
         return content
 
-    def patch(self, content):
+    def patch(self, job, content):
         add_imports = set()
-        content = self.patch_import(content)
-        content = self.patch_from_import(content, add_imports)
-        for line in sorted(add_imports):
-            content = self.patcher.add_import(content, line)
-        return content
+        content = self.patch_import(job, content)
+        content = self.patch_from_import(job, content, add_imports)
+        return self.patcher.add_imports(content, sorted(add_imports), job)
 
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if 'urllib2.parse_http_list' in line:
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
             elif self.FROM_IMPORT_WARN_REGEX.search(line):
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
 class Raise(Operation):
     NAME = "raise"
     DOC = ("replace 'raise exc, msg' with 'raise exc(msg)'"
            " and replace 'raise a, b, c' with 'six.reraise(a, b, c)'")
+    TRIGGERS = ("raise",)
 
     # 'raise a, b, c' expr
     RAISE3_REGEX = re.compile(r"raise (%s), *(%s), *(%s)"
@@ -757,17 +1827,21 @@ class Raise(Operation):
         return ('six.reraise(%s, %s, %s)'
                 % (exc_type, exc_value, exc_tb))
 
-    def patch(self, content):
+    def patch(self, job, content):
         old_content = content
-        content = self.RAISE2_REGEX.sub(self.raise2_replace, content)
-        new_content = self.RAISE3_REGEX.sub(self.raise3_replace, content)
+        content = self.sub(job, self.RAISE2_REGEX, self.raise2_replace,
+                           content)
+        new_content = self.sub(job, self.RAISE3_REGEX, self.raise3_replace,
+                               content)
         if new_content != content:
-            content = self.patcher.add_import_six(new_content)
+            content = self.patcher.add_import_six(new_content, job)
         return content
 
-    def check(self, content):
-        for match in self.RAISE_LINE_REGEX.finditer(content):
-            self.warn_line(match.group(0))
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.RAISE_LINE_REGEX, content,
+                                          lines)
+        for match in matches:
+            self.warn_line(job, match.group(0), match.start())
 
 
 class Except(Operation):
@@ -776,6 +1850,7 @@ class Except(Operation):
            "'except ValueError as exc:', replace "
            "'except (TypeError, ValueError), exc:' with "
            "'except (TypeError, ValueError) as exc:'.")
+    TRIGGERS = ("except",)
 
     # 'except ValueError, exc:'
     EXCEPT_REGEX = re.compile(r"except (%s), *(%s):"
@@ -790,15 +1865,16 @@ class Except(Operation):
     def except_replace(self, regs):
         return 'except %s as %s:' % (regs.group(1), regs.group(2))
 
-    def patch(self, content):
-        content = self.EXCEPT_REGEX.sub(self.except_replace, content)
-        return self.EXCEPT2_REGEX.sub(self.except_replace, content)
+    def patch(self, job, content):
+        content = self.sub(job, self.EXCEPT_REGEX, self.except_replace,
+                           content)
+        return self.sub(job, self.EXCEPT2_REGEX, self.except_replace, content)
 
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if (self.EXCEPT_WARN_REGEX.search(line)
                 or self.EXCEPT_WARN2_REGEX.search(line)):
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
 class SixMoves(Operation):
@@ -861,6 +1937,9 @@ class SixMoves(Operation):
     FUNCTION_REGEX = re.compile(r'(?<!\.)\b(%s)\b( *\()'
                                % '|'.join(SIX_FUNCTIONS))
 
+    TRIGGERS = (tuple(SIX_MODULE_MOVES) + tuple(SIX_BUILTIN_MOVES)
+                + tuple(SIX_FUNCTIONS))
+
     def replace_mock(self, regs):
         name = regs.group(2)
         new_name = self.SIX_MODULE_MOVES[name]
@@ -891,7 +1970,7 @@ class SixMoves(Operation):
         add_imports.add(line)
         return new_name + suffix
 
-    def replace_all_builtins(self, add_imports, content):
+    def replace_all_builtins(self, job, add_imports, content):
         six_builtin_moves = dict(self.SIX_BUILTIN_MOVES)
         for regs in self.BUILTIN_REGEX.finditer(content):
             name = regs.group(1)
@@ -905,11 +1984,11 @@ class SixMoves(Operation):
                 # the symbol comes from six.moves, no need to patch it
                 del six_builtin_moves[name]
 
-        builtin_regex2 = re.compile(r'(?<!\.)\b(%s)\b( *\()'
-                                   % '|'.join(six_builtin_moves))
+        builtin_regex2 = self.patcher.regex_cache.compile(
+            r'(?<!\.)\b(%s)\b( *\()' % '|'.join(six_builtin_moves))
 
         replace_cb = functools.partial(self.replace_builtin, add_imports)
-        return builtin_regex2.sub(replace_cb, content)
+        return self.sub(job, builtin_regex2, replace_cb, content)
 
     def replace_function(self, add_imports, regs):
         new_name = self.SIX_FUNCTIONS[regs.group(1)]
@@ -917,37 +1996,37 @@ class SixMoves(Operation):
         add_imports.add('import six')
         return 'six.%s%s' % (new_name, suffix)
 
-    def replace_all_functions(self, add_imports, content):
+    def replace_all_functions(self, job, add_imports, content):
         replace_cb = functools.partial(self.replace_function, add_imports)
-        return self.FUNCTION_REGEX.sub(replace_cb, content)
+        return self.sub(job, self.FUNCTION_REGEX, replace_cb, content)
 
-    def patch(self, content):
+    def patch(self, job, content):
         add_imports = set()
         replace_names = set()
 
         replace_cb = functools.partial(self.replace_import,
                                        add_imports, replace_names)
-        content = self.IMPORT_REGEX.sub(replace_cb, content)
+        content = self.sub(job, self.IMPORT_REGEX, replace_cb, content)
 
         replace_cb = functools.partial(self.replace_from, add_imports)
-        content = self.FROM_IMPORT_REGEX.sub(replace_cb, content)
+        content = self.sub(job, self.FROM_IMPORT_REGEX, replace_cb, content)
 
-        content = self.replace_all_builtins(add_imports, content)
+        content = self.replace_all_builtins(job, add_imports, content)
 
-        content = self.replace_all_functions(add_imports, content)
+        content = self.replace_all_functions(job, add_imports, content)
 
         for old_name, new_name in replace_names:
             # Only match words
             regex = r'\b(?<!\.)%s\b' % re.escape(old_name)
-            content = re.sub(regex, new_name, content)
-        for line in sorted(add_imports):
-            names = parse_import(line)
-            content = self.patcher.add_import_names(content, line, names)
+            regex = self.patcher.regex_cache.compile(regex)
+            content = self.sub(job, regex, new_name, content)
+        content = self.patcher.add_imports(content, sorted(add_imports), job,
+                                           skip_existing=False)
 
-        content = self.MOCK_REGEX.sub(self.replace_mock, content)
+        content = self.sub(job, self.MOCK_REGEX, self.replace_mock, content)
         return content
 
-    def check(self, content):
+    def check(self, job, content, lines=None):
         pass
 
 
@@ -955,6 +2034,7 @@ class Itertools(Operation):
     NAME = "itertools"
     DOC = ("replace itertools.ifilter with six.moves.filter, "
            "similar change for ifilterfalse, imap, izip and izip_longest")
+    TRIGGERS = ("itertools", "imap")
 
     FUNCTIONS = {
         # itertools function => six.moves function
@@ -986,82 +2066,81 @@ class Itertools(Operation):
         six_func = self.FUNCTIONS[func]
         return 'six.moves.%s' % six_func
 
-    def patch_from_import(self, content):
+    def patch_from_import(self, job, content):
         # Replace itertools.imap with six.moves.map
-        new_content = self.IFUNC_IMPORT_REGEX.sub('', content)
+        new_content = self.sub(job, self.IFUNC_IMPORT_REGEX, '', content)
         if new_content == content:
             return content
 
-        content = self.patcher.add_import_six(new_content)
-        content = self.IFUNC_REGEX.sub(self.replace, content)
+        content = self.patcher.add_import_six(new_content, job)
+        content = self.sub(job, self.IFUNC_REGEX, self.replace, content)
         return content
 
-    def patch_import(self, content):
+    def patch_import(self, job, content):
         # Replace itertools.imap with six.moves.map
-        new_content = self.ITERTOOLS_IFUNC_REGEX.sub(self.replace, content)
+        new_content = self.sub(job, self.ITERTOOLS_IFUNC_REGEX, self.replace,
+                               content)
         if new_content == content:
             return content
 
         content = new_content
         if not self.ITERTOOLS_REGEX.search(content):
             # itertools is no more used, remove it
-            content = self.IMPORT_ITERTOOLS_REGEX.sub('', content)
+            content = self.sub(job, self.IMPORT_ITERTOOLS_REGEX, '', content)
 
-        return self.patcher.add_import_six(content)
+        return self.patcher.add_import_six(content, job)
 
-    def patch(self, content):
-        content = self.patch_from_import(content)
-        content = self.patch_import(content)
+    def patch(self, job, content):
+        content = self.patch_from_import(job, content)
+        content = self.patch_import(job, content)
         return content
 
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if 'imap' in line:
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
-class Dict0(Operation):
+class Dict0(SubOperation):
     NAME = "dict0"
     DOC = ("replace dict.keys()[0] with list(dict.keys())[0], "
            "same for dict.values()[0] and dict.items()[0]")
+    TRIGGERS = (".keys()[", ".values()[", ".items()[")
 
     EXPR_REGEX = re.compile(r'(%s\.(?:keys|values|items)\(\))\[([0-9]+)\]'
                             % EXPR_REGEX)
+    REGEX = EXPR_REGEX
 
     CHECK_REGEX = re.compile(r'\.(?:keys|values|items)\(\)\[[0-9]+\]')
 
     def replace(self, regs):
         return 'list(%s)[%s]' % (regs.group(1), regs.group(2))
 
-    def patch(self, content):
-        return self.EXPR_REGEX.sub(self.replace, content)
-
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if self.CHECK_REGEX.search(line):
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
-class DictAdd(Operation):
+class DictAdd(SubOperation):
     NAME = "dict_add"
     DOC = ('replace "dict.keys() + list2" with "list(dict.keys()) + list2", '
            'same for "dict.values() + list2" and "dict.items() + list2"')
+    TRIGGERS = (".keys()", ".values()", ".items()")
 
     EXPR_REGEX = re.compile(r'(%s\.(?:keys|values|items)\(\))( *\+)'
                             % EXPR_REGEX)
+    REGEX = EXPR_REGEX
 
     CHECK_REGEX = re.compile(r'\.(?:keys|values|items)\(\) *\+')
 
     def replace(self, regs):
         return 'list(%s)%s' % (regs.group(1), regs.group(2))
 
-    def patch(self, content):
-        return self.EXPR_REGEX.sub(self.replace, content)
-
-    def check(self, content):
-        for line in content.splitlines():
+    def check(self, job, content, lines=None):
+        for pos, line in self.iter_check_lines(content, lines):
             if self.CHECK_REGEX.search(line):
-                self.warn_line(line)
+                self.warn_line(job, line, pos)
 
 
 class Print(Operation):
@@ -1069,6 +2148,7 @@ class Print(Operation):
     DOC = ('replace "print msg" with "print(msg)", '
            'replace "print msg," with "print(msg, end=\' \')", '
            'replace "print" with "print()"')
+    TRIGGERS = ("print",)
 
     # 'print msg', 'print "hello"'
     # but don't match: 'print msg,'
@@ -1105,24 +2185,30 @@ class Print(Operation):
     def replace_comma(self, regs):
         return "print%s(%s, end=' ')" % (regs.group(1), regs.group(2))
 
-    def patch(self, content):
-        content = self.REGEX_ARG.sub(self.replace_arg, content)
-        new_content = self.REGEX_INTO.sub(self.replace_into, content)
-        new_content = self.REGEX.sub(self.replace, new_content)
-        new_content = self.REGEX_COMMA.sub(self.replace_comma, new_content)
+    def patch(self, job, content):
+        content = self.sub(job, self.REGEX_ARG, self.replace_arg, content)
+        new_content = self.sub(job, self.REGEX_INTO, self.replace_into,
+                               content)
+        new_content = self.sub(job, self.REGEX, self.replace, new_content)
+        new_content = self.sub(job, self.REGEX_COMMA, self.replace_comma,
+                               new_content)
         if new_content != content:
-            content = self.patcher.add_import(new_content, 'from __future__ import print_function')
+            content = self.patcher.add_import(new_content,
+                                              'from __future__ import print_function',
+                                              job)
         return content
 
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
             line = match.group(0)
-            self.warn_line(line)
+            self.warn_line(job, line, match.start())
 
 
 class String(Operation):
     NAME = "string"
     DOC = 'replace string.func(str, ...) with text.func(...)'
+    TRIGGERS = ("string.",)
 
     # Deprecated functions of the Python 2 string module
     FUNCTIONS = '|'.join((
@@ -1175,6 +2261,9 @@ class String(Operation):
     # don't match 'string.ascii_letters'
     CHECK_REGEX = re.compile(r"^.*\bstring\.(?!ascii_letters).*$", re.MULTILINE)
 
+    # 'import string\n'
+    IMPORT_STRING_REGEX = import_regex(r"string")
+
     def replace(self, regs):
         return '%s.%s()' % (regs.group(2), regs.group(1))
 
@@ -1185,32 +2274,33 @@ class String(Operation):
         new_name = self.ATOX[regs.group(1)]
         return '%s(%s)' % (new_name, regs.group(2))
 
-    def patch(self, content):
+    def patch(self, job, content):
         old_content = content
-        content = self.REGEX.sub(self.replace, content)
-        content = self.REGEX_ARGS.sub(self.replace_args, content)
-        content = self.REGEX_ATOX.sub(self.replace_atox, content)
+        content = self.sub(job, self.REGEX, self.replace, content)
+        content = self.sub(job, self.REGEX_ARGS, self.replace_args, content)
+        content = self.sub(job, self.REGEX_ATOX, self.replace_atox, content)
         if content != old_content:
             if 'string.' not in content:
                 # Remove 'import string'
-                content = import_regex(r"string").sub('', content)
+                content = self.sub(job, self.IMPORT_STRING_REGEX, '', content)
         return content
 
-    def check(self, content):
-        for match in self.CHECK_REGEX.finditer(content):
+    def check(self, job, content, lines=None):
+        matches = self.iter_check_matches(self.CHECK_REGEX, content, lines)
+        for match in matches:
             line = match.group(0)
-            self.warn_line(line)
+            self.warn_line(job, line, match.start())
 
 
 class All(Operation):
     NAME = "all"
     DOC = "apply all available operations"
 
-    def patch(self, content):
+    def patch(self, job, content):
         # All is a virtual operation, it's implemented in Patcher.__init__
         return content
 
-    def check(self, content):
+    def check(self, job, content, lines=None):
         # All is a virtual operation, it's implemented in Patcher.__init__
         pass
 
@@ -1241,15 +2331,241 @@ OPERATION_NAMES = set(operation.NAME for operation in OPERATIONS)
 OPERATION_BY_NAME = {operation.NAME: operation for operation in OPERATIONS}
 
 
+class JsonLinesReport:
+    """Report written while files are patched (--report=jsonl:PATH).
+
+    Write one JSON object per line: a "patch" record per match replaced by
+    an operation and a "warning" record per warning. Records are not kept
+    in memory.
+    """
+
+    def __init__(self, path):
+        # If true, stdout is dedicated to the report
+        self.stdout = (path == '-')
+        if self.stdout:
+            self._file = sys.stdout
+        else:
+            self._file = open(path, "w", encoding="utf-8")
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+
+    def patch(self, job):
+        # Line and column numbers are relative to the original content
+        for operation, lineno, column, old, new in job.replacements:
+            self._write({"type": "patch", "file": job.filename,
+                         "line": lineno, "column": column,
+                         "operation": operation, "old": old, "new": new})
+
+    def warning(self, message):
+        if not isinstance(message, WarningMessage):
+            message = WarningMessage(message)
+        self._write({"type": "warning", "file": message.filename,
+                     "line": message.lineno, "column": message.column,
+                     "operation": message.operation, "text": message.text,
+                     "message": str(message)})
+
+    def close(self):
+        if self.stdout:
+            self._file.flush()
+        else:
+            self._file.close()
+
+
+class RegexCache:
+    """Bounded LRU cache of regular expressions compiled at runtime.
+
+    Patterns built from the content of a file (ex: list of renamed
+    modules) are compiled once per unique pattern, rather than relying on
+    the small internal cache of the re module. The cache can be used by
+    multiple threads.
+    """
+
+    def __init__(self, maxsize=REGEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._regexes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._regexes)
+
+    def compile(self, pattern, flags=0):
+        key = (pattern, flags)
+        with self._lock:
+            regex = self._regexes.get(key)
+            if regex is not None:
+                self._regexes.move_to_end(key)
+                self.hits += 1
+                return regex
+            self.misses += 1
+
+        regex = re.compile(pattern, flags)
+        with self._lock:
+            self._regexes[key] = regex
+            if len(self._regexes) > self.maxsize:
+                self._regexes.popitem(last=False)
+        return regex
+
+
+class ResultCache:
+    """Cache of patch results stored in a SQLite database.
+
+    The key is computed from the file content, the file name, the
+    operations, the options changing the output and the sixer version.
+    """
+
+    def __init__(self, directory, patcher):
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, "results.sqlite")
+        self.connection = sqlite3.connect(filename, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, content TEXT, operations TEXT, "
+            "warnings TEXT, changes TEXT, replacements TEXT)")
+        self._pending = 0
+        self._prefix = patcher.config_key().encode()
+
+    def key(self, filename, data):
+        digest = hashlib.sha256(self._prefix)
+        digest.update(os.fsencode(os.path.abspath(filename)) + b"\0")
+        digest.update(data)
+        return digest.hexdigest()
+
+    def load(self, job, data):
+        """Fill the job from the cache. Return True on cache hit."""
+        cursor = self.connection.execute(
+            "SELECT content, operations, warnings, changes, replacements "
+            "FROM results WHERE key=?", (job.cache_key,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        content, operations, warnings, changes, replacements = row
+        job.applied_operations = set(json.loads(operations))
+        job.warnings = [WarningMessage(message, job.filename, lineno, column,
+                                       operation, text)
+                        for message, lineno, column, operation, text
+                        in json.loads(warnings)]
+        job.changes = json.loads(changes)
+        for change in job.changes:
+            change[4] = set(change[4])
+        job.replacements = [tuple(item) for item in json.loads(replacements)]
+        job.original, job.encoding, job.newline = decode_source(data)
+        if content is None:
+            content = job.original
+        job.content = content
+        return True
+
+    def store(self, job):
+        changes = [change[:4] + [sorted(change[4])]
+                   for change in job.changes]
+        content = job.content if job.modified else None
+        warnings = []
+        for message in job.warnings:
+            if not isinstance(message, WarningMessage):
+                message = WarningMessage(message, job.filename)
+            _, lineno, column, operation = message.location
+            warnings.append([message, lineno, column, operation,
+                             message.text])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            (job.cache_key, content,
+             json.dumps(sorted(job.applied_operations)),
+             json.dumps(warnings), json.dumps(changes),
+             json.dumps(job.replacements)))
+        self._pending += 1
+        if self._pending >= 500:
+            self.connection.commit()
+            self._pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class StatCache:
+    """State of the incremental mode: (st_mtime_ns, st_size, st_ino) of
+    clean files, files which were not modified and didn't emit warnings.
+
+    Clean files whose stat didn't change are skipped without being read.
+    """
+
+    def __init__(self, directory, config, full=False):
+        self.filename = os.path.join(directory, "state.json")
+        self.config = config
+        self.files = {}
+        self.skipped = 0
+        # Files modified after the start are not recorded: their content
+        # can change again without changing st_mtime_ns
+        self._start = time.time_ns()
+        if not full:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, encoding="utf-8") as fp:
+                state = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if state.get("config") == self.config:
+            self.files = state["files"]
+
+    def is_clean(self, filename, stat):
+        record = self.files.get(os.path.abspath(filename))
+        return record == [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+    def update(self, filename, stat, clean):
+        path = os.path.abspath(filename)
+        if clean and stat.st_mtime_ns < self._start:
+            self.files[path] = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+        else:
+            self.files.pop(path, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename) or os.curdir,
+                    exist_ok=True)
+        state = {"config": self.config, "files": self.files}
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump(state, fp)
+        os.replace(tmp, self.filename)
+
+
 class Patcher:
     IMPORT_SIX_REGEX = re.compile(r"^import six$", re.MULTILINE)
 
     def __init__(self, operations, options=None):
+        # Summary of Patcher.main(): the per-file state is stored in FileJob
         self.exitcode = 0
         self.warnings = []
-        self.current_file = None
-        self.options = options
         self.applied_operations = set()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Regular expressions compiled by operations
+        self.regex_cache = RegexCache()
+        # Number of files tokenized to build a CodeMask and time spent
+        self.code_masks = 0
+        self.code_mask_time = 0.0
+        # OperationStats per operation name of the patched files
+        self.stats = {}
+        # Heap of the (elapsed, filename, breakdown) of the slowest files
+        # (--slowest option)
+        self.slowest = []
+        # Callable called with the name of the current step of patch_file()
+        # (ex: an operation name), or None
+        self.progress = None
+
+        self.options = options
+        # Don't patch strings and comments (--code-only)
+        self.code_only = bool(getattr(options, 'code_only', False))
+        # Keep warnings to display them again at the end of main()
+        self.keep_warnings = not getattr(options, 'no_warning_replay', False)
+        # JsonLinesReport opened by main() (--report option)
+        self.report = None
+        # Record replaced matches in FileJob.replacements for the report
+        self.record_replacements = bool(getattr(options, 'report', None))
 
         self.application_modules = set(APPLICATION_MODULES)
         self.third_party_modules = set(THIRD_PARTY_MODULES)
@@ -1270,27 +2586,279 @@ class Patcher:
         for name in discard:
             operations.discard(name)
             operations.discard(name[1:])
-        self.operations = [OPERATION_BY_NAME[name](self)
-                           for name in operations]
+        # Use the order of OPERATIONS to get the same output in every process
+        self.operations = [operation(self) for operation in OPERATIONS
+                           if operation.NAME in operations]
+        self._compile_triggers()
+
+        cache_dir = getattr(options, 'cache_dir', None) or CACHE_DIR
+        if getattr(options, 'cache', False):
+            self.cache = ResultCache(cache_dir, self)
+        else:
+            self.cache = None
+        if getattr(options, 'incremental', False):
+            self.stat_cache = StatCache(cache_dir, self.config_key(),
+                                        getattr(options, 'full', False))
+        else:
+            self.stat_cache = None
+        # os.stat() of files before they are patched (incremental mode)
+        self._file_stats = {}
+        # Written files which were not fsync()-ed yet (--fsync=batch)
+        self._fsync_pending = []
+
+        excludes = DEFAULT_EXCLUDES + tuple(getattr(options, 'exclude', None)
+                                            or ())
+        self._exclude_regex = compile_globs(excludes)
+        includes = getattr(options, 'include', None) or DEFAULT_INCLUDES
+        self._include_regex = compile_globs(includes)
+
+    def config_key(self):
+        """Get a string identifying the configuration: sixer version,
+        operations and options changing the output."""
+        options = self.options
+        with open(__file__, "rb") as fp:
+            source = fp.read()
+        key = [VERSION, hashlib.sha256(source).hexdigest(),
+               sorted(operation.NAME for operation in self.operations),
+               options.max_range, options.app, options.third_party,
+               self.code_only, self.record_replacements]
+        return json.dumps(key)
+
+    def _compile_triggers(self):
+        self._untriggered = set()
+        triggers = set()
+        for operation in self.operations:
+            if operation.TRIGGERS is None:
+                self._untriggered.add(operation)
+            else:
+                triggers.update(operation.TRIGGERS)
+
+        # A trigger found in the content also enables operations having a
+        # trigger which is a substring of it: '.keys()[' enables the dict0
+        # and dict_add operations.
+        self._trigger_operations = {}
+        for trigger in triggers:
+            self._trigger_operations[trigger] = set(
+                operation for operation in self.operations
+                if operation.TRIGGERS is not None
+                and any(text in trigger for text in operation.TRIGGERS))
+
+        if triggers:
+            # Prefer longest triggers
+            triggers = sorted(triggers, key=lambda text: (-len(text), text))
+            regex = '|'.join(map(re.escape, triggers))
+            self._trigger_regex = re.compile(regex)
+        else:
+            self._trigger_regex = None
+
+        # Regex used to skip files without decoding them: None if an
+        # operation is always run
+        if self._untriggered:
+            self._trigger_bytes_regex = None
+        elif triggers:
+            regex = b'|'.join(re.escape(trigger.encode('ascii'))
+                              for trigger in triggers)
+            self._trigger_bytes_regex = re.compile(regex)
+        else:
+            # no operation: nothing to do
+            self._trigger_bytes_regex = re.compile(b'(?!)')
+
+    def active_operations(self, content):
+        """Get the set of operations which may patch content or emit warnings
+        on it: operations having at least one trigger in content.
+
+        Scan content once for all triggers.
+        """
+        operations = set(self._untriggered)
+        if self._trigger_regex is None:
+            return operations
+
+        search = self._trigger_regex.search
+        trigger_operations = self._trigger_operations
+        noperation = len(self.operations)
+        pos = 0
+        while len(operations) < noperation:
+            match = search(content, pos)
+            if match is None:
+                break
+            operations |= trigger_operations[match.group(0)]
+            # Continue at the next character, not at the match end, to find
+            # triggers overlapping the match
+            pos = match.start() + 1
+        return operations
+
+    def _excluded(self, name, relpath):
+        match = self._exclude_regex.match
+        return match(name) is not None or match(relpath) is not None
+
+    def _walk_dir(self, path, seen):
+        # Walk the directory using os.scandir(), skip excluded names. Follow
+        # symbolic links, but a directory or a file (identified by its
+        # device and inode numbers) is only visited once.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        dev = stat.st_dev
+        seen.add((dev, stat.st_ino))
+        include = self._include_regex.match
+
+        stack = [(path, '', dev)]
+        while stack:
+            dirpath, relpath, dev = stack.pop()
+            try:
+                with os.scandir(dirpath) as iterator:
+                    entries = list(iterator)
+            except OSError:
+                continue
 
-    def _walk_dir(self, path):
-        for dirpath, dirnames, filenames in os.walk(path):
-            # Don't walk into .tox
+            subdirs = []
+            for entry in entries:
+                name = entry.name
+                entry_relpath = relpath + name
+                if self._excluded(name, entry_relpath):
+                    continue
+                try:
+                    if entry.is_dir():
+                        # stat() is needed to detect loops and to get the
+                        # device number
+                        stat = entry.stat()
+                        key = (stat.st_dev, stat.st_ino)
+                        if key not in seen:
+                            seen.add(key)
+                            subdirs.append((entry.path, entry_relpath + '/',
+                                            stat.st_dev))
+                        continue
+                    if not include(name) or not entry.is_file():
+                        continue
+                    if entry.is_symlink():
+                        stat = entry.stat()
+                        key = (stat.st_dev, stat.st_ino)
+                    else:
+                        key = (dev, entry.inode())
+                except OSError:
+                    continue
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield entry.path
+
+            # Walk subdirectories in the order of os.scandir()
+            stack.extend(reversed(subdirs))
+
+    def _skip_clean_files(self, filenames):
+        # Incremental mode: skip clean files whose stat didn't change
+        for filename in filenames:
             try:
-                dirnames.remove(".tox")
-            except ValueError:
-                pass
-            for filename in filenames:
-                if filename.endswith(".py"):
-                    yield os.path.join(dirpath, filename)
+                stat = os.stat(filename)
+            except OSError:
+                yield filename
+                continue
+            if self.stat_cache.is_clean(filename, stat):
+                self.stat_cache.skipped += 1
+                continue
+            self._file_stats[filename] = stat
+            yield filename
+
+    def _split_stream(self, fp, separator=b"\0", chunk_size=64 * 1024):
+        # Yield items of a binary stream as soon as they are read. If
+        # separator is None, use the first NUL or newline character found.
+        pending = b""
+        while True:
+            chunk = fp.read1(chunk_size)
+            if not chunk:
+                break
+            pending += chunk
+            if separator is None:
+                nul = pending.find(b"\0")
+                newline = pending.find(b"\n")
+                if nul < 0 and newline < 0:
+                    continue
+                if nul >= 0 and (newline < 0 or nul < newline):
+                    separator = b"\0"
+                else:
+                    separator = b"\n"
+            items = pending.split(separator)
+            pending = items.pop()
+            for item in items:
+                if separator == b"\n":
+                    item = item.rstrip(b"\r")
+                if item:
+                    yield os.fsdecode(item)
+        if separator == b"\n":
+            pending = pending.rstrip(b"\r")
+        if pending:
+            yield os.fsdecode(pending)
+
+    def files_from(self, filename):
+        """Read the list of files to patch from a file, or from stdin if
+        filename is "-" (--files-from option).
+
+        Files are separated by NUL or newline characters. Files are yielded
+        as soon as they are read.
+        """
+        if filename == "-":
+            yield from self._split_stream(sys.stdin.buffer, None)
+        else:
+            with open(filename, "rb") as fp:
+                yield from self._split_stream(fp, None)
+
+    def _filter_files(self, filenames):
+        # Apply --include and --exclude on a list of files
+        include = self._include_regex.match
+        for filename in filenames:
+            relpath = filename.replace(os.sep, '/')
+            parts = relpath.split('/')
+            if not include(parts[-1]):
+                continue
+            if any(self._excluded(part, relpath) for part in parts):
+                continue
+            yield filename
+
+    def git_files(self, paths):
+        """Get Python files tracked by git (--git-files option) or modified
+        since a git reference (--changed-since option) in paths.
+
+        The list is read from git while files are patched.
+        """
+        ref = getattr(self.options, 'changed_since', None)
+        if ref:
+            # Ignore deleted files, use paths relative to the current
+            # directory
+            cmd = ['git', 'diff', '--name-only', '-z', '--diff-filter=d',
+                   '--relative', ref]
+        else:
+            cmd = ['git', 'ls-files', '-z']
+        cmd.append('--')
+        cmd.extend(paths or ['.'])
+
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except OSError as exc:
+            self.warning("Failed to run git: %s" % exc)
+            self.exitcode = 1
+            return
+        with proc:
+            yield from self._filter_files(self._split_stream(proc.stdout))
+            exitcode = proc.wait()
+        if exitcode:
+            self.warning("Command %s failed with exit code %s"
+                         % (' '.join(cmd), exitcode))
+            self.exitcode = 1
 
     def walk(self, paths):
+        # (st_dev, st_ino) of walked directories and files
+        seen = set()
         for path in paths:
             if os.path.isfile(path):
-                yield path
+                stat = os.stat(path)
+                key = (stat.st_dev, stat.st_ino)
+                if key not in seen:
+                    seen.add(key)
+                    yield path
             else:
                 empty = True
-                for filename in self._walk_dir(path):
+                for filename in self._walk_dir(path, seen):
                     yield filename
                     empty = False
                 if empty:
@@ -1302,71 +2870,74 @@ class Patcher:
                         self.warning("Path %s doesn't exist" % path)
                         self.exitcode = 1
 
-    def add_import_names(self, content, import_line, import_names):
+    def _warning(self, job, msg):
+        if job is not None:
+            job.warning(WarningMessage(msg, job.filename))
+        else:
+            self.warning(msg)
+
+    def _add_import_line(self, table, import_line, import_names, job):
+        # Add an import line to an ImportTable
         import_line = import_line.rstrip() + '\n'
+        if job is not None:
+            job.imports_added += 1
 
         create_new_import_group = None
 
-        import_groups = parse_import_groups(content)
+        import_groups = table.groups
         if not import_groups:
-            if content:
-                return import_line + '\n\n' + content
-            else:
-                return import_line
+            table.add_first_group(import_line)
+            return
 
         add_future = (import_names[0] == '__future__')
 
-        if not add_future and import_groups[0][2] == {'__future__'}:
+        index = 0
+        if not add_future and import_groups[0].imports == {'__future__'}:
             # Ignore the first import group: from __future__ import ...
-            del import_groups[0]
-        if len(import_groups) == 3:
-            import_group = import_groups[1]
+            index = 1
+        if len(import_groups) - index == 3:
+            index += 1
         else:
             # Heuristic to locate the import group of third-party modules
             seen_stdlib_group = False
-            for import_group in import_groups:
-                start, end, imports = import_group
+            for index in range(index, len(import_groups)):
+                imports = import_groups[index].imports
                 if any(name.split('.', 1)[0] in self.third_party_modules
                        for name in imports):
                     break
                 if any(name in self.application_modules for name in imports):
                     # application import, add import six before in a new group
-                    create_new_import_group = (start, False)
+                    create_new_import_group = (index, False)
                     break
                 if any(name in STDLIB_MODULES for name in imports):
                     seen_stdlib_group = True
                     if add_future:
                         # stdlib imports, add future imports before in a new group
-                        create_new_import_group = (start, False)
+                        create_new_import_group = (index, False)
                         break
                 if add_future and any(name == '__future__' for name in imports):
                     break
             else:
-                create_new_import_group = (end, True)
+                # no group after the __future__ group: use the last group
+                index = min(index, len(import_groups) - 1)
+                create_new_import_group = (index, True)
                 if not seen_stdlib_group:
-                    self.warning("%s: Failed to find the best place to add %r: "
-                                 "put it at the end. Use --app and "
-                                 "--third-party options."
-                                 % (self.current_file, import_line.rstrip()))
+                    filename = job.filename if job is not None else None
+                    self._warning(job,
+                                  "%s: Failed to find the best place to add %r: "
+                                  "put it at the end. Use --app and "
+                                  "--third-party options."
+                                  % (filename, import_line.rstrip()))
 
         if create_new_import_group is not None:
-            pos, last_group = create_new_import_group
-            part1 = content[:pos]
-            if not part1 or part1.endswith('\n\n'):
-                newline1 = ''
-            else:
-                newline1 = '\n'
-            if last_group:
-                newline2 = '\n\n'
-            else:
-                newline2 = '\n'
-            return part1 + newline1 + import_line + newline2 + content[pos:]
-
-        start, end, imports = import_group
-
-        pos = start
-        while pos < end:
-            line = get_line(content, pos)
+            index, last_group = create_new_import_group
+            table.add_group(index, last_group, import_line)
+            return
+
+        group = import_groups[index]
+        pos = 0
+        while pos < len(group.lines):
+            line = group.lines[pos]
             if line == "\n":
                 break
             try:
@@ -1376,75 +2947,465 @@ class Patcher:
             else:
                 if import_names < names:
                     break
-            pos += len(line)
-
-        return content[:pos] + import_line + content[pos:]
-
-    def add_import(self, content, line):
-        regex = r"^%s *(?:#.*)?$" % re.escape(line)
-        if re.search(regex, content, flags=re.MULTILINE):
+            pos += 1
+        table.insert_line(index, pos, import_line)
+
+    def add_import_names(self, content, import_line, import_names, job=None):
+        table = ImportTable(content)
+        self._add_import_line(table, import_line, import_names, job)
+        return table.render()
+
+    def add_imports(self, content, lines, job=None, skip_existing=True):
+        """Add import lines to content.
+
+        The result is the same as calling add_import() for each line, or
+        add_import_names() if skip_existing is false, but content is only
+        parsed once and rewritten once.
+        """
+        if not lines:
             return content
-        names = parse_import(line)
-        return self.add_import_names(content, line, names)
+        table = ImportTable(content)
+        for line in lines:
+            if skip_existing and table.has_line(line):
+                continue
+            self._add_import_line(table, line, parse_import(line), job)
+        return table.render()
+
+    def add_import(self, content, line, job=None):
+        return self.add_imports(content, [line], job)
 
-    def add_import_six(self, content):
-        return self.add_import(content, 'import six')
+    def add_import_six(self, content, job=None):
+        return self.add_import(content, 'import six', job)
 
     def _display_warning(self, msg):
         print("WARNING: %s" % msg, file=sys.stderr, flush=True)
 
     def warning(self, msg):
         self._display_warning(msg)
-        self.warnings.append(msg)
-
-    def check(self, content):
+        if self.report is not None:
+            self.report.warning(msg)
+        if self.keep_warnings:
+            self.warnings.append(msg)
+
+    def _check_lines(self, job, operations):
+        # Get the lines of job.content containing a trigger of each
+        # operation: {operation: [(start, end), ...]}. Scan the content once
+        # for all triggers.
+        lines = {operation: [] for operation in operations
+                 if operation not in self._untriggered}
+        if not lines:
+            return lines
+
+        content = job.content
+        search = self._trigger_regex.search
+        trigger_operations = self._trigger_operations
+        newlines = None
+        last_line = {}
+        pos = 0
+        while True:
+            match = search(content, pos)
+            if match is None:
+                break
+            pos = match.start()
+            if newlines is None:
+                newlines = job.newline_index()
+            index = bisect.bisect_left(newlines, pos)
+            for operation in trigger_operations[match.group(0)]:
+                if operation not in lines or last_line.get(operation) == index:
+                    continue
+                last_line[operation] = index
+                start = newlines[index - 1] + 1 if index else 0
+                end = newlines[index] if index < len(newlines) else len(content)
+                lines[operation].append((start, end))
+            # Continue at the next character, not at the match end, to find
+            # triggers overlapping the match
+            pos += 1
+        return lines
+
+    def check(self, job, content, operations=None):
+        """Emit warnings on suspicious code of content.
+
+        Operations only check lines containing one of their triggers. The
+        locations of warnings are relative to content, which becomes the
+        content of the job.
+        """
+        job.content = content
+        if operations is None:
+            operations = self.operations
+        lines = self._check_lines(job, operations)
         for operation in self.operations:
-            operation.check(content)
+            if operation not in operations:
+                continue
+            self._set_progress("%s check" % operation.NAME)
+            start_time = time.perf_counter()
+            # operations without trigger check all lines
+            operation.check(job, content, lines.get(operation))
+            job.operation_stats(operation.NAME).check_time += (
+                time.perf_counter() - start_time)
 
     def write_stdout(self, content):
         for line in content.splitlines():
             print(line)
         sys.stdout.flush()
 
-    def patch(self, filename):
-        self.current_file = filename
-
-        with tokenize.open(filename) as fp:
-            content = fp.read()
-
-        modified = set()
+    def patch_job(self, job):
+        """Patch the content of a FileJob.
+
+        Read the file if job.content is None. The file is not modified. The
+        Patcher is not modified either, so it can be used by multiple threads
+        in parallel.
+        """
+        if job.content is None:
+            with open(job.filename, "rb") as fp:
+                data = fp.read()
+            job.content, job.encoding, job.newline = decode_source(data)
+        content = job.content
+        job.original = content
+        job.changes = []
+
+        active = self.active_operations(content)
         for operation in self.operations:
-            new_content = operation.patch(content)
+            if operation not in active:
+                continue
+
+            self._set_progress(operation.NAME)
+            job.content = content
+            stats = job.operation_stats(operation.NAME)
+            stats.chars += len(content)
+            imports = job.imports_added
+            start_time = time.perf_counter()
+            edits = operation.edits(job, content)
+            if edits is None:
+                # Changes of intermediate contents recorded by
+                # Operation.sub() are replaced with the changes of the
+                # whole patch()
+                changes = job.changes
+                new_content = operation.patch(job, content)
+                job.changes = changes
+                job.record_content(content, new_content, operation.NAME)
+            elif edits:
+                new_content = self._apply_edits(job, operation, content,
+                                                edits)
+                stats.matches += len(edits)
+            else:
+                new_content = content
+            stats.patch_time += time.perf_counter() - start_time
+            stats.imports += job.imports_added - imports
             if new_content == content:
                 continue
-            modified.add(operation.NAME)
+            stats.files += 1
+            job.applied_operations.add(operation.NAME)
             content = new_content
-
-        if not modified:
+            # The new content can contain new triggers
+            active = self.active_operations(content)
+
+        self.check(job, content, active)
+        job.content = content
+        return job
+
+    def _apply_edits(self, job, operation, content, edits):
+        new_content = apply_edits(content, edits)
+        if self.record_replacements:
+            for start, end, replacement in edits:
+                job.add_replacement(operation.NAME, start,
+                                    content[start:end], replacement)
+        job.record_edits(edits, operation.NAME)
+        new_content2 = operation.post_patch(job, new_content)
+        job.record_content(new_content, new_content2, operation.NAME)
+        return new_content2
+
+    def _has_triggers(self, data):
+        # Search triggers in the raw content of a file. Return True if the
+        # content must be decoded to search triggers.
+        if self._trigger_bytes_regex.search(data) is not None:
+            return True
+        # Source code can have a coding cookie on the first two lines
+        header = io.BytesIO(data[:MAX_COOKIE_LINES])
+        encoding, _ = tokenize.detect_encoding(header.readline)
+        return not is_ascii_compatible(encoding)
+
+    def _read_file(self, filename):
+        # Read the file content as bytes. Return None if the file cannot
+        # be modified: it doesn't contain any trigger.
+        with open(filename, "rb") as fp:
+            if (self._trigger_bytes_regex is None
+                    or self.options.to_stdout):
+                return fp.read()
+
+            size = os.fstat(fp.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                # Don't read large files without trigger in memory
+                with mmap.mmap(fp.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    if not self._has_triggers(data):
+                        return None
+                    return data[:]
+
+            data = fp.read()
+            if not self._has_triggers(data):
+                return None
+            return data
+
+    def patch_file(self, filename):
+        """Patch a file.
+
+        Files which don't contain any trigger are not decoded: job.content
+        is None in this case, except in --to-stdout mode.
+        """
+        start_time = time.perf_counter()
+        job = FileJob(filename)
+        try:
+            self._set_progress("read")
+            data = self._read_file(filename)
+            if data is None:
+                return job
+
+            if self.cache is not None:
+                job.cache_key = self.cache.key(filename, data)
+                job.cache_hit = self.cache.load(job, data)
+                if job.cache_hit:
+                    return job
+            self._set_progress("decode")
+            job.content, job.encoding, job.newline = decode_source(data)
+            return self.patch_job(job)
+        finally:
+            job.elapsed = time.perf_counter() - start_time
+
+    def _set_progress(self, name):
+        if self.progress is not None:
+            self.progress(name)
+
+    def _write_result(self, job):
+        for msg in job.warnings:
+            self.warning(msg)
+        for name, stats in job.stats.items():
+            total = self.stats.get(name)
+            if total is None:
+                total = self.stats[name] = OperationStats()
+            total.add(stats)
+        slowest = getattr(self.options, 'slowest', None)
+        if slowest:
+            breakdown = sorted(
+                ((stats.patch_time + stats.check_time, name)
+                 for name, stats in job.stats.items()), reverse=True)
+            item = (job.elapsed, job.filename, breakdown)
+            if len(self.slowest) < slowest:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+        if job.code_mask_time:
+            self.code_masks += 1
+            self.code_mask_time += job.code_mask_time
+        if job.cache_hit:
+            self.cache_hits += 1
+        elif job.cache_hit is not None:
+            self.cache_misses += 1
+            self.cache.store(job)
+        stat = self._file_stats.pop(job.filename, None)
+        if stat is not None:
+            clean = not job.modified and not job.warnings
+            self.stat_cache.update(job.filename, stat, clean)
+
+        if not job.modified:
             # no change
-            self.check(content)
             if self.options.to_stdout:
-                self.write_stdout(content)
+                self.write_stdout(job.content)
             return False
 
+        modified = job.applied_operations
+        if self.report is not None:
+            self.report.patch(job)
         if not self.options.quiet:
             self.applied_operations |= modified
-            print("Patch %s with %s" % (filename, ', '.join(sorted(modified))),
+            print("Patch %s with %s"
+                  % (job.filename, ', '.join(sorted(modified))),
                   flush=True)
 
+        if getattr(self.options, 'diff', False):
+            diff = unified_diff(job.filename, job.original, job.content,
+                                job.changes, newline=job.newline,
+                                encoding=job.encoding)
+            # Write the diff in the encoding of the file, so it applies to
+            # the file. unified_diff() already wrote the BOM of utf-8-sig.
+            encoding = job.encoding
+            if encoding == "utf-8-sig":
+                encoding = "utf-8"
+            sys.stdout.flush()
+            sys.stdout.buffer.write(diff.encode(encoding, "surrogateescape"))
+            sys.stdout.buffer.flush()
+
         if not self.options.to_stdout:
             if self.options.write:
-                with open(filename, "rb") as fp:
-                    encoding, _ = tokenize.detect_encoding(fp.readline)
-
-                with open(filename, "w", encoding=encoding) as fp:
-                    fp.write(content)
+                self._write_file(job)
         else:
-            self.write_stdout(content)
-
-        self.check(content)
+            self.write_stdout(job.content)
         return True
 
+    def _write_file(self, job):
+        # Write the file atomically: write a temporary file in the same
+        # directory and then rename it. Keep the encoding, the newline
+        # sequence and the permissions of the file.
+        data = encode_source(job.content, job.encoding, job.newline)
+        filename = os.path.realpath(job.filename)
+        directory, basename = os.path.split(filename)
+        fsync = getattr(self.options, 'fsync', None) or 'never'
+
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp',
+                                   dir=directory)
+        try:
+            with open(fd, "wb") as fp:
+                fp.write(data)
+                if fsync == 'always':
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            os.chmod(tmp, stat.S_IMODE(os.stat(filename).st_mode))
+            os.replace(tmp, filename)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+        if fsync == 'batch':
+            self._fsync_pending.append(filename)
+            if len(self._fsync_pending) >= FSYNC_BATCH:
+                self.flush_writes()
+
+    def flush_writes(self):
+        """Flush written files to the disk in the 'batch' fsync policy:
+        fsync() files and then their directories."""
+        directories = set()
+        for filename in self._fsync_pending:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(filename))
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._fsync_pending.clear()
+
+    def patch(self, filename):
+        job = self.patch_file(filename)
+        return self._write_result(job)
+
+    def write_stats(self):
+        """Display the table of Patcher.stats, slowest operations first."""
+        print()
+        print("%-12s %10s %10s %7s %8s %8s %12s"
+              % ("Operation", "Patch (s)", "Check (s)", "Files", "Matches",
+                 "Imports", "Characters"))
+        items = sorted(self.stats.items(),
+                       key=lambda item: (-(item[1].patch_time
+                                           + item[1].check_time), item[0]))
+        for name, stats in items:
+            print("%-12s %10.3f %10.3f %7s %8s %8s %12s"
+                  % (name, stats.patch_time, stats.check_time, stats.files,
+                     stats.matches, stats.imports, stats.chars))
+
+    def write_slowest(self):
+        """Display the slowest files with the time spent per operation."""
+        print()
+        print("Slowest files:")
+        for elapsed, filename, breakdown in sorted(self.slowest,
+                                                   reverse=True):
+            operations = ', '.join("%s: %.3f" % (name, seconds)
+                                   for seconds, name in breakdown)
+            print("- %.3f sec: %s (%s)" % (elapsed, filename, operations))
+
+    def _patch_timeout(self, filenames, jobs, timeout, initializer=None):
+        # Yield (filename, future) in the order of filenames, only when
+        # the future is done. Each file is patched in a worker process which
+        # is killed if it takes longer than timeout seconds: the result is
+        # a FileTimeout exception. The timeout starts when the worker
+        # starts to patch the file, not when the worker process is spawned.
+        # If set, initializer(patcher) is called in each worker process
+        # with the Patcher of the worker.
+        names = [operation.NAME for operation in self.operations]
+
+        def spawn():
+            return _TimeoutWorker(names, self.options, initializer)
+
+        workers = [spawn() for _ in range(jobs)]
+        idle = list(workers)
+        pending = collections.deque()
+        filenames = iter(filenames)
+        exhausted = False
+        try:
+            while True:
+                while idle and not exhausted and len(pending) < jobs * 4:
+                    filename = next(filenames, None)
+                    if filename is None:
+                        exhausted = True
+                        break
+                    future = concurrent.futures.Future()
+                    pending.append((filename, future))
+                    idle.pop().submit(filename, future)
+
+                while pending and pending[0][1].done():
+                    yield pending.popleft()
+                if not pending:
+                    if exhausted:
+                        break
+                    continue
+
+                busy = [worker for worker in workers
+                        if worker.future is not None]
+                deadlines = [worker.deadline for worker in busy
+                             if worker.deadline is not None]
+                if deadlines:
+                    wait_timeout = max(min(deadlines) - time.monotonic(), 0)
+                else:
+                    # no worker started to patch its file yet
+                    wait_timeout = None
+                ready = multiprocessing.connection.wait(
+                    [worker.conn for worker in busy], wait_timeout)
+                for worker in busy:
+                    if worker.conn in ready:
+                        if worker.receive(timeout):
+                            idle.append(worker)
+                    elif (worker.deadline is not None
+                          and worker.deadline <= time.monotonic()):
+                        worker.timeout(timeout)
+                        index = workers.index(worker)
+                        workers[index] = spawn()
+                        idle.append(workers[index])
+        finally:
+            for worker in workers:
+                worker.close()
+
+    def _patch_parallel(self, filenames, jobs):
+        # Yield (filename, future) in the order of filenames. The pool is
+        # only created when there are at least two files to patch.
+        filenames = iter(filenames)
+        first = next(filenames, None)
+        if first is None:
+            return
+        second = next(filenames, None)
+        if second is None:
+            yield first, None
+            return
+
+        names = [operation.NAME for operation in self.operations]
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=_init_worker,
+                initargs=(names, self.options)) as executor:
+            pending = collections.deque()
+            for filename in itertools.chain((first, second), filenames):
+                future = executor.submit(_worker_patch, filename)
+                pending.append((filename, future))
+                # Bound the number of queued files to limit memory usage
+                if len(pending) >= jobs * 4:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
     @staticmethod
     def usage(parser):
         parser.print_help()
@@ -1472,6 +3433,16 @@ class Patcher:
         parser.add_option(
             '-w', '--write', action="store_true",
             help='Really modify files in place')
+        parser.add_option(
+            '-d', '--diff', action="store_true",
+            help='Write a unified diff of patched files into stdout '
+                 '(imply --quiet option)')
+        parser.add_option(
+            '--fsync', type="choice", choices=('never', 'always', 'batch'),
+            default='never',
+            help=('fsync() policy of written files: never, always (before '
+                  'replacing each file) or batch (groups of %s files and '
+                  'their directories, default: never)' % FSYNC_BATCH))
         parser.add_option(
             '--app', type="str",
             help='Name of the application module, used to sort and group '
@@ -1483,6 +3454,77 @@ class Patcher:
         parser.add_option(
             '-q', '--quiet', action="store_true",
             help='Be quiet')
+        parser.add_option(
+            '--cache', action="store_true",
+            help=('Cache results in the %s directory, skip files which '
+                  'were already patched' % CACHE_DIR))
+        parser.add_option(
+            '--cache-dir', type="str",
+            help='Directory of the cache and of the incremental state '
+                 '(imply --cache option)')
+        parser.add_option(
+            '--git-files', action="store_true",
+            help=('Patch Python files tracked by git in paths instead of '
+                  'walking directories (default path: current directory)'))
+        parser.add_option(
+            '--changed-since', metavar="REF",
+            help=('Patch Python files modified since the git reference REF '
+                  'in paths (default path: current directory)'))
+        parser.add_option(
+            '--files-from', metavar="FILE",
+            help=('Read the list of files to patch from FILE ("-" for '
+                  'stdin), separated by NUL or newline characters'))
+        parser.add_option(
+            '--exclude', action="append", metavar="GLOB",
+            help=('Skip directories and files matching the glob pattern '
+                  'when walking directories (default: %s)'
+                  % ', '.join(DEFAULT_EXCLUDES)))
+        parser.add_option(
+            '--include', action="append", metavar="GLOB",
+            help=('Only patch files matching the glob pattern when walking '
+                  'directories (default: %s)' % ', '.join(DEFAULT_INCLUDES)))
+        parser.add_option(
+            '--incremental', action="store_true",
+            help=('Skip clean files (not modified, no warning) of the '
+                  'previous run if their size and modification time '
+                  'didn\'t change'))
+        parser.add_option(
+            '--full', action="store_true",
+            help='Scan all files in the incremental mode '
+                 '(imply --incremental option)')
+        parser.add_option(
+            '-j', '--jobs', type="int",
+            help=("Number of processes used to patch files "
+                  "(default: number of CPUs)"))
+        parser.add_option(
+            '--report', metavar="FORMAT:PATH",
+            help=("Write a report of patched files and warnings into PATH "
+                  "while files are patched. The only supported format is "
+                  "jsonl (JSON Lines), ex: --report=jsonl:report.jsonl. "
+                  "Use - as PATH to write into stdout: other messages "
+                  "are then written into stderr."))
+        parser.add_option(
+            '--no-warning-replay', action="store_true",
+            help=("Don't display all warnings again at the end: warnings "
+                  "are not kept in memory"))
+        parser.add_option(
+            '--stats', action="store_true",
+            help=("Display statistics per operation at the end: time spent "
+                  "to patch and check files, number of patched files, "
+                  "matches, added imports and scanned characters"))
+        parser.add_option(
+            '--slowest', type="int", metavar="N",
+            help=("Display the N slowest files with the time spent "
+                  "per operation at the end"))
+        parser.add_option(
+            '--file-timeout', type="float", metavar="SECONDS",
+            help=("Patch each file in a worker process which is killed if "
+                  "the file takes longer than SECONDS: the file is skipped "
+                  "with a warning naming the stuck operation"))
+        parser.add_option(
+            '--code-only', action="store_true",
+            help=("Don't patch strings and comments: find them using the "
+                  "tokenize module"))
         parser.add_option(
             '--max-range', type="int",
             help=("Don't use six.moves.xrange for ranges smaller than "
@@ -1490,12 +3532,32 @@ class Patcher:
             default=MAX_RANGE)
 
         options, args = parser.parse_args()
-        if len(args) < 2:
+        no_path = (options.git_files or options.changed_since
+                   or options.files_from)
+        if len(args) < (1 if no_path else 2):
             Patcher.usage(parser)
             sys.exit(1)
 
-        if options.to_stdout:
+        if options.to_stdout and options.diff:
+            parser.error("--to-stdout and --diff options are incompatible")
+        if options.to_stdout or options.diff:
+            if options.stats or options.slowest:
+                parser.error("--stats and --slowest options are "
+                             "incompatible with --to-stdout and --diff "
+                             "options")
             options.quiet = True
+        if options.report:
+            report_format, _, report_path = options.report.partition(':')
+            if report_format != 'jsonl' or not report_path:
+                parser.error("invalid --report value: %r, expected "
+                             "jsonl:PATH" % options.report)
+            if report_path == '-' and (options.to_stdout or options.diff):
+                parser.error("--report=jsonl:- is incompatible with "
+                             "--to-stdout and --diff options")
+        if options.cache_dir:
+            options.cache = True
+        if options.full:
+            options.incremental = True
 
         operations = args[0].split(',')
         paths = args[1:]
@@ -1512,31 +3574,99 @@ class Patcher:
         return options, operations, paths
 
     def main(self, paths):
+        report = getattr(self.options, 'report', None)
+        if report:
+            self.report = JsonLinesReport(report.partition(':')[2])
+        if self.report is not None and self.report.stdout:
+            # stdout is dedicated to the report
+            with contextlib.redirect_stdout(sys.stderr):
+                self._main(paths)
+        else:
+            self._main(paths)
+
+    def _main(self, paths):
         if not self.options.write and not self.options.quiet:
             print("(Dry run: don't modify files)", file=sys.stderr)
             print(file=sys.stderr)
 
+        files_from = getattr(self.options, 'files_from', None)
+        if (getattr(self.options, 'git_files', False)
+                or getattr(self.options, 'changed_since', None)):
+            filenames = self.git_files(paths)
+        elif files_from:
+            filenames = self.files_from(files_from)
+            if paths:
+                filenames = itertools.chain(self.walk(paths), filenames)
+        else:
+            filenames = self.walk(paths)
+        if self.stat_cache is not None:
+            filenames = self._skip_clean_files(filenames)
+        jobs = getattr(self.options, 'jobs', None) or os.cpu_count() or 1
+        timeout = getattr(self.options, 'file_timeout', None)
+        if timeout:
+            files = self._patch_timeout(filenames, jobs, timeout)
+        elif jobs > 1:
+            files = self._patch_parallel(filenames, jobs)
+        else:
+            files = ((filename, None) for filename in filenames)
+
         nfiles = 0
-        for filename in self.walk(paths):
+        for filename, future in files:
             try:
-                self.patch(filename)
+                if future is not None:
+                    job = future.result()
+                    self.regex_cache.hits += job.regex_hits
+                    self.regex_cache.misses += job.regex_misses
+                    self._write_result(job)
+                else:
+                    self.patch(filename)
+            except FileTimeout as exc:
+                self._file_stats.pop(filename, None)
+                self.warning(str(exc))
             except Exception:
                 print("ERROR while patching %s" % filename)
                 raise
             nfiles += 1
 
-        print()
+        if not getattr(self.options, 'diff', False):
+            # keep the diff parsable
+            print()
         if not self.options.quiet:
             print("Scanned %s files" % nfiles)
+        self.flush_writes()
+        if self.stat_cache is not None:
+            self.stat_cache.save()
+            if not self.options.quiet:
+                print("Skipped %s unchanged clean files (incremental mode)"
+                      % self.stat_cache.skipped)
         if self.applied_operations:
             operations = sorted(self.applied_operations)
             print("Applied operations (%s): %s"
                   % (len(self.applied_operations), ', '.join(operations)))
+        if self.cache is not None:
+            self.cache.close()
+            if not self.options.quiet:
+                print("Cache: %s hits, %s misses"
+                      % (self.cache_hits, self.cache_misses))
+        if self.code_masks and not self.options.quiet:
+            print("Code mask: tokenized %s files in %.1f sec"
+                  % (self.code_masks, self.code_mask_time))
+        regex_cache = self.regex_cache
+        if ((regex_cache.hits or regex_cache.misses)
+                and getattr(self.options, 'stats', False)):
+            print("Regex cache: %s hits, %s misses"
+                  % (regex_cache.hits, regex_cache.misses))
+        if getattr(self.options, 'stats', False):
+            self.write_stats()
+        if self.slowest:
+            self.write_slowest()
         if self.warnings:
             print(file=sys.stderr)
             print("Warnings:", file=sys.stderr)
         for msg in self.warnings:
             self._display_warning(msg)
+        if self.report is not None:
+            self.report.close()
         if not self.options.write and not self.options.quiet:
             print(file=sys.stderr)
             print("Now retry with --write option to really modify files "
@@ -1544,6 +3674,122 @@ class Patcher:
         sys.exit(self.exitcode)
 
 
+# Patcher of a worker process of Patcher.main()
+_WORKER_PATCHER = None
+
+
+def _init_worker(operations, options):
+    global _WORKER_PATCHER
+    _WORKER_PATCHER = Patcher(operations, options)
+
+
+def _worker_patch(filename):
+    regex_cache = _WORKER_PATCHER.regex_cache
+    hits = regex_cache.hits
+    misses = regex_cache.misses
+    job = _WORKER_PATCHER.patch_file(filename)
+    job.regex_hits = regex_cache.hits - hits
+    job.regex_misses = regex_cache.misses - misses
+    # the parent process only needs the time spent to build the mask
+    job.code_mask = None
+    job._newlines = job._newlines_content = None
+    options = _WORKER_PATCHER.options
+    if not job.modified and not options.to_stdout:
+        # the parent process doesn't need the content
+        job.content = None
+    if not job.modified or not getattr(options, 'diff', False):
+        job.original = None
+        if not getattr(options, 'cache', False):
+            job.changes = []
+    return job
+
+
+class _TimeoutWorker:
+    # Worker process of Patcher._patch_timeout(). The worker writes the
+    # name of its current step into shared memory, so the parent process
+    # knows which operation is stuck when it kills the worker. The worker
+    # sends None when it starts to patch a file: the deadline starts there.
+
+    def __init__(self, operations, options, initializer=None):
+        self.progress = multiprocessing.RawArray('c', PROGRESS_SIZE)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_timeout_worker,
+            args=(child_conn, operations, options, self.progress,
+                  initializer),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.filename = None
+        self.future = None
+        self.deadline = None
+
+    def submit(self, filename, future):
+        self.filename = filename
+        self.future = future
+        self.deadline = None
+        self.conn.send(filename)
+
+    def receive(self, timeout):
+        # Return True if the result of the file was received
+        message = self.conn.recv()
+        if message is None:
+            self.deadline = time.monotonic() + timeout
+            return False
+        ok, result = message
+        if ok:
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(result)
+        self.future = None
+        self.deadline = None
+        return True
+
+    def timeout(self, timeout):
+        operation = self.progress.value.decode('ascii', 'replace')
+        self.process.kill()
+        self.close()
+        self.future.set_exception(FileTimeout(self.filename, timeout,
+                                              operation))
+        self.future = None
+
+    def close(self):
+        if self.process.is_alive() and self.future is None:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        else:
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def _timeout_worker(conn, operations, options, progress, initializer):
+    _init_worker(operations, options)
+    if initializer is not None:
+        initializer(_WORKER_PATCHER)
+
+    def set_progress(name):
+        progress.value = name.encode('ascii', 'replace')[:PROGRESS_SIZE - 1]
+
+    _WORKER_PATCHER.progress = set_progress
+    while True:
+        filename = conn.recv()
+        if filename is None:
+            break
+        conn.send(None)
+        try:
+            result = (True, _worker_patch(filename))
+        except Exception as exc:
+            result = (False, exc)
+        try:
+            conn.send(result)
+        except Exception as exc:
+            # the exception cannot be pickled
+            conn.send((False, RuntimeError("%s: %r" % (filename, exc))))
+
+
 def main():
     options, operations, paths = Patcher.parse_options()
     Patcher(operations, options).main(paths)
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
+import codecs
+import concurrent.futures
 import contextlib
 import io
+import json
 import os
+import random
+import re
 import shutil
 import sixer
 import subprocess
 import sys
 import tempfile
 import textwrap
+import time
 import types
 import unittest
+import unittest.mock
 
 
 SIXER = os.path.join(os.path.dirname(__file__), "sixer.py")
@@ -26,13 +33,15 @@ def replace_stream(attr):
         setattr(sys, attr, old_stream)
 
 
-def run_sixer(operation, *args):
-    args = (sys.executable, SIXER, '--write', operation) + args
+def run_sixer(operation, *args, options=(), cwd=None, stdin=None):
+    args = (sys.executable, SIXER, '--write') + tuple(options) + (operation,) + args
     proc = subprocess.Popen(args,
+                            stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+                            stderr=subprocess.PIPE,
+                            cwd=cwd)
     with proc:
-        stdout, stderr = proc.communicate()
+        stdout, stderr = proc.communicate(stdin)
         exitcode = proc.wait()
 
     return (exitcode, os.fsdecode(stdout), os.fsdecode(stderr))
@@ -46,9 +55,21 @@ def mock_options(kw):
     options.app = kw.pop('app', None)
     options.third_party = kw.pop('third_party', None)
     options.write = True
+    options.code_only = kw.pop('code_only', False)
     return options
 
 
+def hang_long_operation(patcher):
+    # Initializer of Patcher._patch_timeout() workers: the long operation
+    # hangs. Defined at module level to be passed to the worker process.
+    def hang(regs):
+        time.sleep(60)
+
+    for operation in patcher.operations:
+        if operation.NAME == 'long':
+            operation.replace_int_l = hang
+
+
 class AddImportTests(unittest.TestCase):
     def check(self, line, before, after, **kw):
         # Keywords: app=None
@@ -134,6 +155,36 @@ class AddImportTests(unittest.TestCase):
         """, app='app')
 
 
+    def test_add_imports(self):
+        options = mock_options({'app': 'myapp'})
+        patcher = sixer.Patcher(('print',), options)
+        # ignore "Failed to find the best place" warnings
+        patcher._display_warning = lambda msg: None
+        lines = ['from __future__ import print_function',
+                 'from six.moves import range',
+                 'import myapp',
+                 'import six']
+        codes = ('', 'code\n', '\n\ncode\n',
+                 'import sys\n\ncode\n',
+                 'import six  # noqa\nimport sys\n\nimport myapp\n\ncode\n',
+                 'from __future__ import division\n\nimport os\n\n'
+                 'import requests\n\nimport myapp.db\n\ncode\n',
+                 '"""doc"""\nimport os\ncode\nimport six\n')
+        for code in codes:
+            for skip_existing in (True, False):
+                with self.subTest(code=code, skip_existing=skip_existing):
+                    expected = code
+                    for line in lines:
+                        if skip_existing:
+                            expected = patcher.add_import(expected, line)
+                        else:
+                            names = sixer.parse_import(line)
+                            expected = patcher.add_import_names(expected,
+                                                                line, names)
+                    output = patcher.add_imports(code, lines,
+                                                 skip_existing=skip_existing)
+                    self.assertEqual(output, expected)
+
     def test_add_future(self):
         # no import before
         self.check('from __future__ import print_function', """
@@ -193,6 +244,319 @@ class TestUtils(unittest.TestCase):
                          [(0, 27, {'a', 'b', 'c'})])
 
 
+    def test_active_operations(self):
+        patcher = sixer.Patcher(('all',), mock_options({}))
+
+        def active(content):
+            operations = patcher.active_operations(content)
+            return sorted(operation.NAME for operation in operations)
+
+        self.assertEqual(active('x = 1\n'), [])
+        self.assertEqual(active('for k, v in d.iteritems():\n'),
+                         ['iteritems'])
+        self.assertEqual(active('x = 1L\nprint x\n'), ['long', 'print'])
+        # '.keys()[' contains the '.keys()' trigger of dict_add
+        self.assertEqual(active('k = d.keys()[0]\n'), ['dict0', 'dict_add'])
+        # overlapping triggers: '0x' and 'xrange'
+        self.assertEqual(active('10xrange\n'), ['long', 'xrange'])
+
+    def test_check_lines(self):
+        patcher = sixer.Patcher(('xrange', 'print'), mock_options({}))
+        xrange, print_ = patcher.operations
+        code = 'x = 1\nfor i in xrange (3): print\n\nprint x\n'
+        lines = patcher._check_lines(sixer.FileJob('test.py', code),
+                                      patcher.operations)
+        self.assertEqual(lines, {xrange: [(6, 32)],
+                                 print_: [(6, 32), (34, 41)]})
+
+        job = sixer.FileJob('test.py', code)
+        patcher.check(job, code)
+        self.assertEqual(job.warnings,
+                         ['[xrange] test.py: for i in xrange (3): print',
+                          '[print] test.py: for i in xrange (3): print',
+                          '[print] test.py: print x'])
+        self.assertEqual([message.location for message in job.warnings],
+                         [('test.py', 2, 1, 'xrange'),
+                          ('test.py', 2, 1, 'print'),
+                          ('test.py', 4, 1, 'print')])
+
+    def test_apply_edits(self):
+        self.assertEqual(sixer.apply_edits('abcdef', []), 'abcdef')
+        # edits don't have to be sorted
+        self.assertEqual(sixer.apply_edits('abcdef', [(4, 5, ''),
+                                                      (0, 1, 'AA'),
+                                                      (2, 2, '-')]),
+                         'AAb-cdf')
+        with self.assertRaises(sixer.EditConflict):
+            sixer.apply_edits('abcdef', [(0, 3, 'x'), (2, 4, 'y')])
+
+    def test_regex_cache(self):
+        cache = sixer.RegexCache(maxsize=2)
+        regex = cache.compile('a+')
+        self.assertIs(cache.compile('a+'), regex)
+        self.assertEqual(cache.compile('a+', re.MULTILINE).flags & re.MULTILINE,
+                         re.MULTILINE)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        # 'a+' is the least recently used pattern
+        cache.compile('b+')
+        self.assertEqual(len(cache), 2)
+        cache.compile('a+')
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+        # SixMoves compiles the regex of renamed modules once
+        patcher = sixer.Patcher(('six_moves',), mock_options({}))
+        code = 'import HTMLParser\n\nHTMLParser.HTMLParser()\n'
+        for _ in range(3):
+            patcher.patch_job(sixer.FileJob('x.py', code))
+        self.assertEqual(patcher.regex_cache.misses, 2)
+        self.assertEqual(patcher.regex_cache.hits, 4)
+
+    def test_decode_source(self):
+        self.assertEqual(sixer.decode_source(b"x = 1\r\ny = 2\r\n"),
+                         ("x = 1\ny = 2\n", "utf-8", "\r\n"))
+        self.assertEqual(sixer.decode_source(b"# coding: latin1\n\xe9\r\n"),
+                         ("# coding: latin1\n\xe9\n", "latin1", "\n"))
+        self.assertEqual(sixer.decode_source(b"x = 1"), ("x = 1", "utf-8", "\n"))
+        self.assertEqual(sixer.encode_source("a\nb\n", "utf-8", "\r"),
+                         b"a\rb\r")
+
+    def test_unified_diff(self):
+        patcher = sixer.Patcher(('all',), mock_options({}))
+        before = ('import os\n'
+                  + 'x = 1\n' * 8
+                  + 'y = d.iteritems().next()\n'
+                  + 'print y')
+        job = patcher.patch_job(sixer.FileJob('test.py', before))
+        diff = sixer.unified_diff('test.py', job.original, job.content,
+                                  job.changes)
+        self.assertEqual(diff,
+                         '--- a/test.py\n'
+                         '+++ b/test.py\n'
+                         '@@ -1,4 +1,8 @@\n'
+                         ' import os\n'
+                         '+\n'
+                         '+import six\n'
+                         '+\n'
+                         '+\n'
+                         ' x = 1\n'
+                         ' x = 1\n'
+                         ' x = 1\n'
+                         '@@ -7,5 +11,5 @@\n'
+                         ' x = 1\n'
+                         ' x = 1\n'
+                         ' x = 1\n'
+                         '-y = d.iteritems().next()\n'
+                         '-print y\n'
+                         '\\ No newline at end of file\n'
+                         '+y = next(six.iteritems(d))\n'
+                         '+print(y)\n'
+                         '\\ No newline at end of file\n')
+
+    @unittest.skipUnless(sixer.ATOMIC_REGEX,
+                         'need possessive quantifiers (Python 3.11)')
+    def test_expr_regexes(self):
+        # the atomic build must match exactly as the backtracking build
+        templates = (
+            r"(%(expr)s)\.iteritems\(\)",
+            r"(%(expr)s|%(parent)s)\.next\(\)",
+            r"raise (%(expr)s), *(%(expr)s), *(%(expr)s)",
+            r"(%(expr)s\.(?:keys|values|items)\(\))\[([0-9]+)\]",
+            r"\bprint ?( *)>>(%(expr)s), *(%(expr_string)s)(?! *,)$",
+            r"\bstring\.(split)\((%(expr_string)s), *([^)]+)\)",
+        )
+        tokens = ('obj', 'x1', '.', '[', ']', '(', ')', ',', ' ', '"', "'",
+                  '\\', '\n', 'iteritems()', 'next()', 'keys()', '[0]',
+                  'print >>', 'raise ', 'string.split(', '"s"', 'f(x)')
+        regexes = []
+        for atomic in (True, False):
+            expr, string, expr_string = sixer.expr_regexes(atomic)
+            names = {'expr': expr, 'expr_string': expr_string,
+                     'parent': sixer.PARENT_REGEX}
+            regexes.append([re.compile(template % names, re.MULTILINE)
+                            for template in templates])
+        self.assertNotEqual(regexes[0][0].pattern, regexes[1][0].pattern)
+
+        rng = random.Random(23)
+        for _ in range(2000):
+            text = ''.join(rng.choice(tokens)
+                           for _ in range(rng.randint(1, 20)))
+            for atomic, backtrack in zip(*regexes):
+                self.assertEqual(
+                    [(m.span(), m.groups()) for m in atomic.finditer(text)],
+                    [(m.span(), m.groups()) for m in backtrack.finditer(text)],
+                    text)
+
+
+class TestFileJob(unittest.TestCase):
+    def test_threads(self):
+        # One Patcher can patch multiple files in parallel using threads
+        options = mock_options({})
+        patcher = sixer.Patcher(('all',), options)
+
+        jobs = []
+        for index in range(20):
+            if index % 2:
+                content = "x = d.iteritems()\nprint x\n"
+            else:
+                content = "x = %sL\nunicode.lower(u'x')\n" % index
+            jobs.append(sixer.FileJob("file%s.py" % index, content))
+
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            list(executor.map(patcher.patch_job, jobs))
+
+        for index, job in enumerate(jobs):
+            if index % 2:
+                self.assertEqual(job.applied_operations,
+                                 {'iteritems', 'print'})
+                self.assertEqual(job.content,
+                                 "import six\n\n\n"
+                                 "x = six.iteritems(d)\n"
+                                 "print(x)\n")
+            else:
+                self.assertEqual(job.applied_operations,
+                                 {'long', 'unicode'})
+                self.assertEqual(job.content,
+                                 "import six\n\n\n"
+                                 "x = %s\n"
+                                 "six.text_type.lower(u'x')\n" % index)
+            self.assertEqual(job.warnings, [])
+        self.assertEqual(patcher.warnings, [])
+
+    def test_changes(self):
+        job = sixer.FileJob('test.py', 'abcdefghij')
+        job.record_edits([(1, 2, 'XX'), (5, 6, '')], 'a')
+        self.assertEqual(job.changes, [[1, 2, 1, 3, {'a'}],
+                                       [5, 6, 6, 6, {'a'}]])
+        # the edit rewrites a part of the first change: regions are merged
+        job.record_edits([(2, 4, 'Y')], 'b')
+        self.assertEqual(job.changes, [[1, 3, 1, 3, {'a', 'b'}],
+                                       [5, 6, 5, 5, {'a'}]])
+        job.record_content('aXYdeghij', 'aXYdeghij!', 'c')
+        self.assertEqual(job.changes[-1], [10, 10, 9, 10, {'c'}])
+
+    def test_overlapping_edits(self):
+        patcher = sixer.Patcher(('iteritems', 'next'), mock_options({}))
+        job = sixer.FileJob('test.py', 'y = 1\nx = d.iteritems().next()\n')
+        patcher.patch_job(job)
+        self.assertEqual(job.content,
+                         'import six\n\n\n'
+                         'y = 1\n'
+                         'x = next(six.iteritems(d))\n')
+        # next rewrites the output of iteritems: it's not a conflict
+        self.assertEqual(job.warnings, [])
+        self.assertEqual([(job.original[change[0]:change[1]],
+                           job.content[change[2]:change[3]])
+                          for change in job.changes],
+                         [('', 'import six\n\n\n'),
+                          ('d.iteritems().next()', 'next(six.iteritems(d))')])
+
+    def test_location(self):
+        job = sixer.FileJob('test.py', 'x = 1\n\n  y = 2\n')
+        self.assertEqual(list(job.newline_index()), [5, 6, 14])
+        self.assertEqual(job.location(0), (1, 1))
+        self.assertEqual(job.location(5), (1, 6))
+        self.assertEqual(job.location(6), (2, 1))
+        self.assertEqual(job.location(9), (3, 3))
+
+        patcher = sixer.Patcher(('except',), mock_options({}))
+        job = sixer.FileJob('test.py', 'x = 1\n    except (A), e :\n')
+        patcher.patch_job(job)
+        self.assertEqual(job.warnings, ['[except] test.py: except (A), e :'])
+        self.assertEqual(job.warnings[0].location,
+                         ('test.py', 2, 5, 'except'))
+
+    def test_stats(self):
+        patcher = sixer.Patcher(('iteritems', 'itervalues', 'unicode',
+                                 'xrange'), mock_options({}))
+        job = sixer.FileJob('test.py',
+                            'for i in xrange(n): unicode\n'
+                            'x = d.iteritems(), d.itervalues(), e.iteritems()\n')
+        patcher.patch_job(job)
+        counters = {name: (stats.files, stats.matches, stats.imports)
+                    for name, stats in job.stats.items()}
+        self.assertEqual(counters, {'iteritems': (1, 2, 1),
+                                    'itervalues': (1, 1, 0),
+                                    'unicode': (1, 1, 0),
+                                    # xrange only implements patch(): matches
+                                    # are counted by Operation.sub()
+                                    'xrange': (1, 1, 1)})
+        self.assertGreater(job.stats['iteritems'].patch_time, 0.0)
+        self.assertGreater(job.stats['iteritems'].check_time, 0.0)
+        self.assertEqual(job.stats['iteritems'].chars, 77)
+
+    def test_code_mask(self):
+        code = 'x = "a#b"  # c\ny = """\n"""\n'
+        mask = sixer.CodeMask(code)
+        self.assertEqual(list(zip(mask.starts, mask.ends)),
+                         [(4, 9), (11, 14), (19, 26)])
+        self.assertEqual([pos for pos in range(len(code))
+                          if mask.is_code(pos)],
+                         [0, 1, 2, 3, 9, 10, 14, 15, 16, 17, 18, 26])
+        # unclosed bracket: regions before the error are kept
+        mask = sixer.CodeMask('x = "a"\nf(\n')
+        self.assertEqual(list(zip(mask.starts, mask.ends)), [(4, 7)])
+
+    def test_code_only(self):
+        patcher = sixer.Patcher(('iteritems', 'next', 'unicode'),
+                                mock_options({'code_only': True}))
+        job = sixer.FileJob('test.py',
+                            'x = d.iteritems()  # d.iteritems()\n'
+                            'y = "it.next() unicode"\n'
+                            'z = it.next(), unicode\n')
+        patcher.patch_job(job)
+        self.assertEqual(job.content,
+                         'import six\n\n\n'
+                         'x = six.iteritems(d)  # d.iteritems()\n'
+                         'y = "it.next() unicode"\n'
+                         'z = next(it), six.text_type\n')
+        # positions of the patched content are mapped to the original content
+        self.assertTrue(job.is_code(job.content.index('six.iteritems')))
+        self.assertFalse(job.is_code(job.content.index('# d.')))
+        self.assertFalse(job.is_code(job.content.index('it.next() u')))
+        self.assertGreater(job.code_mask_time, 0.0)
+
+    def test_code_only_patch(self):
+        # operations only implementing patch() run multiple substitutions
+        # and add imports between them
+        patcher = sixer.Patcher(('print', 'raise', 'long', 'xrange',
+                                 'stringio'),
+                                mock_options({'code_only': True}))
+        job = sixer.FileJob('test.py',
+                            'import StringIO\n'
+                            '\n'
+                            '\n'
+                            'def f():\n'
+                            '    """\n'
+                            '    print "hello"\n'
+                            '    StringIO.StringIO()\n'
+                            '    """\n'
+                            '    print "x"\n'
+                            '    # raise E, "msg"\n'
+                            '    raise E, "msg"\n'
+                            '    x = 1L  # 2L\n'
+                            '    s = "3L"\n'
+                            '    return StringIO.StringIO(), xrange(5)'
+                            '  # xrange(3)\n')
+        patcher.patch_job(job)
+        self.assertEqual(job.content,
+                         'import six\n'
+                         '\n'
+                         '\n'
+                         '\n'
+                         'def f():\n'
+                         '    """\n'
+                         '    print "hello"\n'
+                         '    StringIO.StringIO()\n'
+                         '    """\n'
+                         '    print("x")\n'
+                         '    # raise E, "msg"\n'
+                         '    raise E("msg")\n'
+                         '    x = 1  # 2L\n'
+                         '    s = "3L"\n'
+                         '    return six.StringIO(), range(5)'
+                         '  # xrange(3)\n')
+
+
 class TestOperations(unittest.TestCase):
     def _check(self, operation, before, after, **kw):
         warnings = kw.pop('warnings', None)
@@ -209,8 +573,9 @@ class TestOperations(unittest.TestCase):
             temp.flush()
             with replace_stream('stdout'), replace_stream('stderr'):
                 patcher.patch(temp.name)
-            temp.seek(0)
-            code = temp.read()
+            # the file is replaced, open it again
+            with open(temp.name) as fp:
+                code = fp.read()
 
         self.assertEqual(code, after)
         if not ignore_warnings:
@@ -232,8 +597,9 @@ class TestOperations(unittest.TestCase):
             self.assertEqual(exitcode, 0)
             #self.assertEqual(stderr, '')
 
-            tmp.seek(0)
-            code = tmp.read()
+            # the file is replaced, open it again
+            with open(tmp.name) as fp:
+                code = fp.read()
 
         self.assertEqual(code, after)
 
@@ -439,6 +805,20 @@ class TestOperations(unittest.TestCase):
             isinstance('hello', six.string_types)
             """)
 
+    def test_patch_unicode(self):
+        patcher = sixer.Patcher(('unicode',), mock_options({}))
+        operation = patcher.operations[0]
+        code = ('x = unicode(unicode(y))  # unicode\n'
+                'def unicode(x=unicode): """unicode"""\n'
+                'from unicode import unicode\x0cdef f(x=unicode): pass\n')
+        self.assertEqual(operation.patch_unicode(code),
+                         'x = six.text_type(six.text_type(y))  # unicode\n'
+                         'def unicode(x=six.text_type): """unicode"""\n'
+                         'from unicode import unicode\x0c'
+                         'def f(x=six.text_type): pass\n')
+        code = 'import unicodedata\n'
+        self.assertIs(operation.patch_unicode(code), code)
+
     def test_add_six_import(self):
         # only stdlib
         self.check("unicode",
@@ -578,6 +958,16 @@ class TestOperations(unittest.TestCase):
             "item = ((x * 2) for x in data).next()",
             "item = next((x * 2) for x in data)")
 
+        self.check("next",
+            "item = (f(x) + 1 for x in data).next()",
+            "item = next(f(x) + 1 for x in data)")
+
+        # missing closing parenthesis: must not backtrack on each split of
+        # the text after the opening parenthesis
+        code = "item = (" + "x " * 20000 + ".next()\n"
+        self.check_unchanged("next", code, ignore_warnings=True,
+                             check_program=False)
+
         self.check_unchanged("next",
             """
             import six
@@ -1319,6 +1709,161 @@ class TestOperations(unittest.TestCase):
             """)
 
 
+class TestWalk(unittest.TestCase):
+    def create_tree(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for name in ('a.py', 'data.txt', '.git/x.py', 'build/y.py',
+                     'node_modules/z.py', 'sub/b.py', 'sub/skip_c.py'):
+            filename = os.path.join(path, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "w", encoding="ASCII") as f:
+                f.write("x = 1\n")
+        # symbolic link loop and file reached by two paths
+        os.symlink(path, os.path.join(path, 'sub', 'loop'))
+        os.symlink(os.path.join(path, 'a.py'), os.path.join(path, 'link.py'))
+        return path
+
+    def walk(self, path, **kw):
+        options = mock_options({})
+        for key, value in kw.items():
+            setattr(options, key, value)
+        patcher = sixer.Patcher(('all',), options)
+        filenames = list(patcher.walk([path]))
+        self.assertEqual(len(filenames), len(set(filenames)))
+        return sorted(os.path.relpath(filename, path)
+                      for filename in filenames)
+
+    def test_walk(self):
+        path = self.create_tree()
+        files = self.walk(path)
+        self.assertEqual(len(files), 3)
+        self.assertIn(files[0], ('a.py', 'link.py'))
+        self.assertEqual(files[1:], ['sub/b.py', 'sub/skip_c.py'])
+
+    def test_exclude_include(self):
+        path = self.create_tree()
+        files = self.walk(path, exclude=['sub/skip_*', 'link.py'])
+        self.assertEqual(files, ['a.py', 'sub/b.py'])
+        files = self.walk(path, include=['*.txt'])
+        self.assertEqual(files, ['data.txt'])
+
+
+class TestPrefilter(unittest.TestCase):
+    def patch_file(self, data):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "test.py")
+        with open(filename, "wb") as f:
+            f.write(data)
+        patcher = sixer.Patcher(('all',), mock_options({}))
+        return patcher.patch_file(filename)
+
+    def check(self, data):
+        # files without trigger are not decoded
+        job = self.patch_file(data)
+        self.assertIsNone(job.content)
+        self.assertFalse(job.modified)
+
+        job = self.patch_file(data + b"x = 1L\n")
+        self.assertEqual(job.applied_operations, {'long'})
+
+    def test_prefilter(self):
+        self.check(b"x = 1\n")
+
+        # the invalid UTF-8 file is not decoded
+        data = b"x = 1\ny = 2\nz = '\xff'\n"
+        self.assertIsNone(self.patch_file(data).content)
+        with self.assertRaises(UnicodeDecodeError):
+            self.patch_file(data + b"x = 1L\n")
+
+    def test_mmap(self):
+        with unittest.mock.patch.object(sixer, 'MMAP_THRESHOLD', 10):
+            self.check(b"x = 1\n" * 10)
+
+    def test_encoding(self):
+        # ASCII is encoded differently in EBCDIC: the file is decoded
+        job = self.patch_file(b"# coding: cp037\n")
+        self.assertIsNotNone(job.content)
+
+
+class TestWriteFile(unittest.TestCase):
+    def patch(self, data, options=None):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "test.py")
+        with open(filename, "wb") as f:
+            f.write(data)
+        os.chmod(filename, 0o751)
+
+        patcher = sixer.Patcher(('all',), mock_options({}))
+        patcher.options.fsync = options
+        with replace_stream('stdout'):
+            patcher.patch(filename)
+        patcher.flush_writes()
+
+        self.assertEqual(os.listdir(path), ["test.py"])
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o751)
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_newline(self):
+        self.assertEqual(self.patch(b"x = 1L\r\ny = 2L\r\n"),
+                         b"x = 1\r\ny = 2\r\n")
+        self.assertEqual(self.patch(b"x = 1L\ry = 2L\r"),
+                         b"x = 1\ry = 2\r")
+
+    def test_encoding(self):
+        self.assertEqual(self.patch(b"# coding: latin1\nx = 1L  # \xe9\n"),
+                         b"# coding: latin1\nx = 1  # \xe9\n")
+        self.assertEqual(self.patch(b"\xef\xbb\xbfx = 1L  # \xc3\xa9\n"),
+                         b"\xef\xbb\xbfx = 1  # \xc3\xa9\n")
+
+    def test_fsync(self):
+        for policy in ('always', 'batch'):
+            self.assertEqual(self.patch(b"x = 1L\n", policy), b"x = 1\n")
+
+
+class TestResultCache(unittest.TestCase):
+    def test_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "test.py")
+        with open(filename, "w", encoding="ASCII") as f:
+            f.write("x = d.iteritems()\nf(d.\n  iteritems())\n")
+
+        patcher = sixer.Patcher(('iteritems',), mock_options({}))
+        patcher.cache = sixer.ResultCache(os.path.join(path, "cache"), patcher)
+        self.addCleanup(patcher.cache.close)
+        jobs = [patcher.patch_file(filename)]
+        patcher.cache.store(jobs[0])
+        jobs.append(patcher.patch_file(filename))
+        self.assertEqual([job.cache_hit for job in jobs], [False, True])
+        self.assertEqual(jobs[1].content,
+                         "import six\n\n\n"
+                         "x = six.iteritems(d)\nf(d.\n  iteritems())\n")
+        self.assertEqual(jobs[1].applied_operations, {'iteritems'})
+        self.assertEqual(jobs[1].changes, jobs[0].changes)
+        self.assertEqual(len(jobs[1].warnings), 1)
+        self.assertEqual(jobs[1].warnings[0].location,
+                         (filename, 6, 3, 'iteritems'))
+
+    def test_key(self):
+        patcher = sixer.Patcher(('iteritems',), mock_options({}))
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = sixer.ResultCache(path, patcher)
+        self.addCleanup(cache.close)
+        self.assertNotEqual(cache.key("a.py", b"x"), cache.key("a.py", b"y"))
+        self.assertNotEqual(cache.key("a.py", b"x"), cache.key("b.py", b"x"))
+
+        patcher2 = sixer.Patcher(('iteritems',),
+                                 mock_options({'max_range': 10}))
+        cache2 = sixer.ResultCache(path, patcher2)
+        self.addCleanup(cache2.close)
+        self.assertNotEqual(cache.key("a.py", b"x"), cache2.key("a.py", b"x"))
+
+
 class TestProgram(unittest.TestCase):
     def run_sixer(self, scanned, *paths):
         exitcode, stdout, stderr = run_sixer("all", *paths)
@@ -1335,8 +1880,9 @@ class TestProgram(unittest.TestCase):
 
             stdout = self.run_sixer(1, tmp.name)
 
-            tmp.seek(0)
-            code = tmp.read()
+            # the file is replaced, open it again
+            with open(tmp.name) as fp:
+                code = fp.read()
             self.assertEqual(code, "x = 1\n")
 
     def test_patch_dir(self):
@@ -1362,6 +1908,344 @@ class TestProgram(unittest.TestCase):
 
             self.assertEqual(code, after, "file=%r" % filename)
 
+    def test_report(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "test.py")
+        with open(filename, "w", encoding="ASCII") as f:
+            f.write("x = 1L\ntry: pass\nexcept (A), e :\n")
+        report = os.path.join(path, "report.jsonl")
+
+        exitcode, stdout, stderr = run_sixer(
+            "long,except", filename,
+            options=['--report=jsonl:%s' % report, '--no-warning-replay'])
+        self.assertEqual(exitcode, 0)
+        # the warning is not displayed again at the end
+        self.assertEqual(stderr,
+                         'WARNING: [except] %s: except (A), e :\n'
+                         % filename)
+
+        with open(report, encoding="utf-8") as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(records, [
+            {"type": "warning", "file": filename, "line": 3, "column": 1,
+             "operation": "except", "text": "except (A), e :",
+             "message": "[except] %s: except (A), e :" % filename},
+            {"type": "patch", "file": filename, "line": 1, "column": 5,
+             "operation": "long", "old": "1L", "new": "1"},
+        ])
+
+        # stdout is dedicated to the report
+        with open(filename, "w", encoding="ASCII") as f:
+            f.write("x = 1L\ny = 2L\n")
+        exitcode, stdout, stderr = run_sixer(
+            "long", filename, options=['--report=jsonl:-'])
+        self.assertEqual(exitcode, 0)
+        self.assertIn("Patch %s with long\n" % filename, stderr)
+        records = [json.loads(line) for line in stdout.splitlines()]
+        self.assertEqual(records, [
+            {"type": "patch", "file": filename, "line": 1, "column": 5,
+             "operation": "long", "old": "1L", "new": "1"},
+            {"type": "patch", "file": filename, "line": 2, "column": 5,
+             "operation": "long", "old": "2L", "new": "2"},
+        ])
+
+        exitcode, stdout, stderr = run_sixer(
+            "long", filename, options=['--report=jsonl:-', '--diff'])
+        self.assertEqual(exitcode, 2)
+        self.assertIn("--report=jsonl:- is incompatible", stderr)
+
+        exitcode, stdout, stderr = run_sixer("long", filename,
+                                             options=['--report=xml:x'])
+        self.assertEqual(exitcode, 2)
+        self.assertIn("invalid --report value", stderr)
+
+    def test_stats(self):
+        with tempfile.NamedTemporaryFile("w+", encoding="ASCII") as tmp:
+            tmp.write("x = 1L\n")
+            tmp.flush()
+            exitcode, stdout, stderr = run_sixer("long,xrange", tmp.name,
+                                                 options=['--stats'])
+        self.assertEqual(exitcode, 0)
+        table = stdout.split('\n\n')[-1].splitlines()
+        self.assertEqual(table[0].split()[:3], ['Operation', 'Patch', '(s)'])
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table[1].split()[0], 'long')
+        self.assertEqual(table[1].split()[3:5], ['1', '1'])
+
+        exitcode, stdout, stderr = run_sixer("long", tmp.name,
+                                             options=['--stats', '--diff'])
+        self.assertEqual(exitcode, 2)
+        self.assertIn("--stats and --slowest options are incompatible",
+                      stderr)
+
+    def test_jobs(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        def create_files():
+            for index in range(5):
+                filename = os.path.join(path, "file%s.py" % index)
+                with open(filename, "w", encoding="ASCII") as f:
+                    f.write("x = %sL\nunicode\nxrange(n)\n" % index)
+
+        outputs = []
+        for jobs in (1, 3):
+            create_files()
+            outputs.append(run_sixer("all", path, options=['--jobs=%s' % jobs]))
+        self.assertEqual(outputs[0], outputs[1])
+
+        exitcode, stdout, stderr = outputs[1]
+        self.assertEqual(exitcode, 0)
+        self.assertIn('Scanned 5 files\n', stdout)
+        self.assertIn('Applied operations (3): long, unicode, xrange\n',
+                      stdout)
+        for index in range(5):
+            filename = os.path.join(path, "file%s.py" % index)
+            with open(filename, encoding="ASCII") as f:
+                self.assertEqual(f.read(),
+                                 "import six\n"
+                                 "from six.moves import range\n"
+                                 "\n\n"
+                                 "x = %s\n"
+                                 "six.text_type\n"
+                                 "range(n)\n" % index)
+
+    def test_slowest(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for index in range(3):
+            filename = os.path.join(path, "file%s.py" % index)
+            with open(filename, "w", encoding="ASCII") as f:
+                f.write("x = %sL\nunicode\n" % index)
+
+        exitcode, stdout, stderr = run_sixer("long,unicode", path,
+                                             options=['--slowest=2'])
+        self.assertEqual(exitcode, 0)
+        report = stdout.split('Slowest files:\n')[1].splitlines()
+        self.assertEqual(len(report), 2)
+        for line in report:
+            self.assertRegex(line, r'^- [0-9.]+ sec: .*file[0-2]\.py '
+                                   r'\((long|unicode): [0-9.]+, '
+                                   r'(long|unicode): [0-9.]+\)$')
+
+    def test_file_timeout(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filenames = [os.path.join(path, "file%s.py" % index)
+                     for index in range(2)]
+
+        def create_files():
+            for filename, code in zip(filenames, ("x = 1L\n", "xrange(n)\n")):
+                with open(filename, "w", encoding="ASCII") as f:
+                    f.write(code)
+
+        create_files()
+
+        exitcode, stdout, stderr = run_sixer("long,xrange", path,
+                                             options=['--file-timeout=60'])
+        self.assertEqual(exitcode, 0)
+        self.assertIn('Scanned 2 files\n', stdout)
+        with open(filenames[0], encoding="ASCII") as f:
+            self.assertEqual(f.read(), "x = 1\n")
+
+        options = mock_options({})
+        options.jobs = 1
+        patcher = sixer.Patcher(('long', 'xrange'), options)
+        create_files()
+        results = list(patcher._patch_timeout(filenames, 1, 0.5,
+                                              hang_long_operation))
+
+        self.assertEqual([filename for filename, future in results],
+                         filenames)
+        exc = results[0][1].exception()
+        self.assertIsInstance(exc, sixer.FileTimeout)
+        self.assertEqual(exc.operation, 'long')
+        self.assertIn('(stuck in long)', str(exc))
+        # the killed worker is replaced
+        job = results[1][1].result()
+        self.assertEqual(job.applied_operations, {'xrange'})
+
+    def test_diff(self):
+        with tempfile.NamedTemporaryFile("w+", encoding="ASCII",
+                                         suffix=".py") as tmp:
+            tmp.write("x = 1L\ny = 2\n")
+            tmp.flush()
+
+            exitcode, stdout, stderr = run_sixer("all", tmp.name,
+                                                 options=['--diff'])
+
+            # the file is replaced, open it again
+            with open(tmp.name) as fp:
+                code = fp.read()
+
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(stderr, '')
+        self.assertEqual(code, "x = 1\ny = 2\n")
+        path = os.path.relpath(tmp.name).replace(os.sep, "/")
+        self.assertEqual(stdout,
+                         '--- a/%s\n'
+                         '+++ b/%s\n'
+                         '@@ -1,2 +1,2 @@\n'
+                         '-x = 1L\n'
+                         '+x = 1\n'
+                         ' y = 2\n' % (path, path))
+
+    @unittest.skipIf(shutil.which('git') is None, 'need git')
+    def test_diff_bom(self):
+        # The diff of a file starting with a UTF-8 BOM can be applied
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "bom.py")
+        original = codecs.BOM_UTF8 + b"x = 1L\ny = 2\n"
+        with open(filename, "wb") as fp:
+            fp.write(original)
+
+        proc = subprocess.run((sys.executable, SIXER, '--write', '--diff',
+                               'all', 'bom.py'),
+                              cwd=path, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, check=True)
+        self.assertEqual(proc.stderr, b'')
+        self.assertIn(b'-\xef\xbb\xbfx = 1L\n+\xef\xbb\xbfx = 1\n y = 2\n',
+                      proc.stdout)
+        with open(filename, "rb") as fp:
+            patched = fp.read()
+        self.assertEqual(patched, codecs.BOM_UTF8 + b"x = 1\ny = 2\n")
+
+        with open(filename, "wb") as fp:
+            fp.write(original)
+        subprocess.run(('git', 'apply', '-'), input=proc.stdout,
+                       cwd=path, check=True)
+        with open(filename, "rb") as fp:
+            self.assertEqual(fp.read(), patched)
+
+    @unittest.skipIf(shutil.which('git') is None, 'need git')
+    def test_diff_latin1(self):
+        # The diff is written in the encoding of the file
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "lat.py")
+        with open(filename, "wb") as fp:
+            fp.write(b"# -*- coding: latin-1 -*-\nx = '\xe9', 1L\n")
+
+        # dry run: the file is not modified
+        proc = subprocess.run((sys.executable, SIXER, '--diff', 'all',
+                               'lat.py'),
+                              cwd=path, stdout=subprocess.PIPE, check=True)
+        self.assertIn(b"-x = '\xe9', 1L\n+x = '\xe9', 1\n", proc.stdout)
+        subprocess.run(('git', 'apply', '-'), input=proc.stdout,
+                       cwd=path, check=True)
+        with open(filename, "rb") as fp:
+            self.assertEqual(fp.read(),
+                             b"# -*- coding: latin-1 -*-\nx = '\xe9', 1\n")
+
+    def test_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, "test.py")
+        with open(filename, "w", encoding="ASCII") as f:
+            # files without trigger are not looked up in the cache
+            f.write("print(1)\n")
+
+        options = ['--cache-dir', os.path.join(path, 'cache')]
+        exitcode, stdout, stderr = run_sixer("all", filename, options=options)
+        self.assertEqual(exitcode, 0)
+        self.assertIn('Cache: 0 hits, 1 misses\n', stdout)
+
+        exitcode, stdout, stderr = run_sixer("all", filename, options=options)
+        self.assertEqual(exitcode, 0)
+        self.assertIn('Cache: 1 hits, 0 misses\n', stdout)
+
+    def test_incremental(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for name, code in (("clean.py", "x = 1\n"), ("dirty.py", "x = 1L\n")):
+            with open(os.path.join(path, name), "w", encoding="ASCII") as f:
+                f.write(code)
+
+        options = ['--incremental', '--cache-dir', os.path.join(path, 'cache')]
+        for scanned, skipped, extra_options in ((2, 0, []),
+                                                # dirty.py was patched
+                                                (1, 1, []),
+                                                (0, 2, []),
+                                                (2, 0, ['--full'])):
+            exitcode, stdout, stderr = run_sixer(
+                "all", path, options=options + extra_options)
+            self.assertEqual(exitcode, 0)
+            self.assertIn('Scanned %s files\n' % scanned, stdout)
+            self.assertIn('Skipped %s unchanged clean files' % skipped, stdout)
+
+    @unittest.skipIf(shutil.which('git') is None, 'need git')
+    def test_git_files(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        def git(*args):
+            subprocess.check_call(('git', '-c', 'user.name=sixer',
+                                   '-c', 'user.email=sixer@example.com')
+                                  + args,
+                                  cwd=path, stdout=subprocess.DEVNULL)
+
+        def write(name, code):
+            with open(os.path.join(path, name), "w", encoding="ASCII") as f:
+                f.write(code)
+
+        def read(name):
+            with open(os.path.join(path, name), encoding="ASCII") as f:
+                return f.read()
+
+        git('init', '-q')
+        write('tracked.py', 'x = 1L\n')
+        write('other.py', 'y = 1\n')
+        git('add', 'tracked.py', 'other.py')
+        git('commit', '-q', '-m', 'init')
+        write('untracked.py', 'z = 1L\n')
+
+        exitcode, stdout, stderr = run_sixer("all", options=['--git-files'],
+                                             cwd=path)
+        self.assertEqual((exitcode, stderr), (0, ''))
+        self.assertIn('Scanned 2 files\n', stdout)
+        self.assertEqual(read('tracked.py'), 'x = 1\n')
+        self.assertEqual(read('untracked.py'), 'z = 1L\n')
+
+        git('commit', '-q', '-a', '-m', 'sixer')
+        write('other.py', 'y = 2L\n')
+        exitcode, stdout, stderr = run_sixer(
+            "all", options=['--changed-since', 'HEAD'], cwd=path)
+        self.assertEqual((exitcode, stderr), (0, ''))
+        self.assertIn('Scanned 1 files\n', stdout)
+        self.assertEqual(read('other.py'), 'y = 2\n')
+
+    def test_files_from(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filenames = []
+        for index in range(3):
+            filename = os.path.join(path, "file %s.py" % index)
+            with open(filename, "w", encoding="ASCII") as f:
+                f.write("x = 1L\n")
+            filenames.append(filename)
+
+        # NUL separator from stdin
+        stdin = os.fsencode('\0'.join(filenames[:2]) + '\0')
+        exitcode, stdout, stderr = run_sixer("all", options=['--files-from=-'],
+                                             stdin=stdin)
+        self.assertEqual((exitcode, stderr), (0, ''))
+        self.assertIn('Scanned 2 files\n', stdout)
+
+        # newline separator from a file
+        manifest = os.path.join(path, "manifest")
+        with open(manifest, "w") as f:
+            f.write('%s\r\n\n%s\n' % (filenames[0], filenames[2]))
+        exitcode, stdout, stderr = run_sixer(
+            "all", options=['--files-from=%s' % manifest])
+        self.assertEqual((exitcode, stderr), (0, ''))
+        self.assertIn('Scanned 2 files\n', stdout)
+
+        for filename in filenames:
+            with open(filename, encoding="ASCII") as f:
+                self.assertEqual(f.read(), "x = 1\n")
+
     def test_empty_dir(self):
         path = tempfile.mkdtemp()
         self.addCleanup(shutil.rmtree, path)